@@ -1,9 +1,12 @@
 #include <stdio.h>
+#include <errno.h>
 #include <netdb.h>
 #include <assert.h>
 #include <string.h>
 #include <time.h>
 #include <unistd.h>
+#include <sys/un.h>
+#include <sys/time.h>
 #include <openssl/sha.h>
 #include "tada.h"
 
@@ -12,7 +15,16 @@ void _submit(test_t test, char *msg_buf, size_t cnt)
 	int rc;
 	FILE *log = stdout;
 	static int line_no = 0;
-	if (test->flags & TADA_TEST_F_SEND_RESULT) {
+	if ((test->flags & TADA_TEST_F_SEND_RESULT) && test->stream) {
+		/* newline-delimited JSON */
+		rc = send(test->udp_fd, msg_buf, cnt, MSG_NOSIGNAL);
+		if (rc >= 0)
+			rc = send(test->udp_fd, "\n", 1, MSG_NOSIGNAL);
+		if (rc < 0) {
+			fprintf(stderr, "Failed to send a message to "
+					"the TADA server, error %d.\n", errno);
+		}
+	} else if (test->flags & TADA_TEST_F_SEND_RESULT) {
 		rc = sendto(test->udp_fd, msg_buf, cnt, 0,
 				(struct sockaddr *)&test->sin,
 				sizeof(test->sin));
@@ -32,6 +44,58 @@ void _submit(test_t test, char *msg_buf, size_t cnt)
 	line_no++;
 }
 
+/*
+ * Connect the stream socket to "tcp://HOST:PORT" or "unix://PATH" (`addr` is
+ * the part after "://"). Returns the socket, or -1 on error.
+ */
+static int _stream_connect(test_t test, const char *scheme, char *addr)
+{
+	int fd;
+	struct timeval tv = { .tv_sec = TADAD_ACK_TIMEOUT };
+
+	if (0 == strcmp(scheme, "unix")) {
+		struct sockaddr_un sun = { .sun_family = AF_UNIX };
+		snprintf(sun.sun_path, sizeof(sun.sun_path), "%s", addr);
+		fd = socket(AF_UNIX, SOCK_STREAM, 0);
+		if (fd >= 0 && connect(fd, (struct sockaddr *)&sun, sizeof(sun))) {
+			close(fd);
+			fd = -1;
+		}
+	} else {
+		fd = socket(AF_INET, SOCK_STREAM, 0);
+		if (fd >= 0 && connect(fd, (struct sockaddr *)&test->sin,
+				       sizeof(test->sin))) {
+			close(fd);
+			fd = -1;
+		}
+	}
+	if (fd < 0) {
+		fprintf(stderr, "Failed to connect to the TADA server %s://%s, "
+				"error %d.\n", scheme, addr, errno);
+		return -1;
+	}
+	setsockopt(fd, SOL_SOCKET, SO_RCVTIMEO, &tv, sizeof(tv));
+	return fd;
+}
+
+/* Wait for the ack of test-finish from the stream */
+static void _stream_wait_ack(test_t test)
+{
+	char buf[1024];
+	ssize_t len = 0, rc;
+
+	while (len < sizeof(buf) - 1) {
+		rc = recv(test->udp_fd, buf + len, sizeof(buf) - 1 - len, 0);
+		if (rc <= 0)
+			break;
+		len += rc;
+		buf[len] = '\0';
+		if (strstr(buf, test->test_id) && strchr(buf, '\n'))
+			return;
+	}
+	fprintf(stderr, "The test is not acknowledged by the TADA server.\n");
+}
+
 /*
  * { "msg-type" : "test-start",
  *   "test-suite" : <suite-name>,
@@ -46,6 +110,8 @@ void tada_start(test_t test)
 	char msg_buf[1024];
 	char *tada_addr = getenv("TADA_ADDR");
 	char *tada_host;
+	char *scheme = "udp";
+	char *p;
 	short tada_port;
 	struct hostent *h;
 	unsigned char md[32];
@@ -73,12 +139,31 @@ void tada_start(test_t test)
 		tada_port = htons(TADAD_PORT);
 	} else {
 		char *s = strdup(tada_addr);
-		tada_host = strtok(s, ":");
-		tada_port = htons(atoi(strtok(NULL, ":")));
+		/* [udp://|tcp://]HOST[:PORT] or unix://PATH */
+		p = strstr(s, "://");
+		if (p) {
+			*p = '\0';
+			scheme = s;
+			s = p + 3;
+		}
+		if (0 == strcmp(scheme, "unix")) {
+			tada_host = s;
+			tada_port = 0;
+		} else {
+			tada_host = strtok(s, ":");
+			p = strtok(NULL, ":");
+			tada_port = htons(p ? atoi(p) : TADAD_PORT);
+		}
+	}
+	test->stream = (0 != strcmp(scheme, "udp"));
+	if (0 != strcmp(scheme, "unix")) {
+		h = gethostbyname(tada_host);
+		assert(h);
+		assert (h->h_addrtype == AF_INET);
+		test->sin.sin_addr.s_addr = *(unsigned int *)(h->h_addr_list[0]);
+		test->sin.sin_family = h->h_addrtype;
+		test->sin.sin_port = tada_port;
 	}
-	h = gethostbyname(tada_host);
-	assert(h);
-	assert (h->h_addrtype == AF_INET);
 
 	ts = time(NULL);
 
@@ -96,10 +181,6 @@ void tada_start(test_t test)
 		snprintf(&test->test_id[i*2], 3, "%02hhx", md[i]);
 	}
 
-	test->sin.sin_addr.s_addr = *(unsigned int *)(h->h_addr_list[0]);
-	test->sin.sin_family = h->h_addrtype;
-	test->sin.sin_port = tada_port;
-
 	cnt = snprintf(msg_buf, sizeof(msg_buf),
 		       "{ \"msg-type\" : \"test-start\","
 		       "\"test-suite\" : \"%s\","
@@ -121,8 +202,14 @@ void tada_start(test_t test)
 		       test->test_id
 		       );
 	assert(cnt < sizeof(msg_buf));
-	test->udp_fd = socket(AF_INET, SOCK_DGRAM, 0);
-	assert(test->udp_fd >= 0);
+	if (test->stream && (test->flags & TADA_TEST_F_SEND_RESULT)) {
+		test->udp_fd = _stream_connect(test, scheme, tada_host);
+		if (test->udp_fd < 0) /* results are only logged */
+			test->flags &= ~TADA_TEST_F_SEND_RESULT;
+	} else {
+		test->udp_fd = socket(AF_INET, SOCK_DGRAM, 0);
+		assert(test->udp_fd >= 0);
+	}
 	_submit(test, msg_buf, cnt);
 }
 
@@ -165,7 +252,10 @@ void tada_finish(test_t test)
 		       );
 	assert(cnt < sizeof(msg_buf));
 	_submit(test, msg_buf, cnt);
-	close(test->udp_fd);
+	if (test->stream && (test->flags & TADA_TEST_F_SEND_RESULT))
+		_stream_wait_ack(test);
+	if (test->udp_fd >= 0)
+		close(test->udp_fd);
 	test->udp_fd = -1;
 	if (test->log_file) {
 		fprintf(test->log_file, "]");
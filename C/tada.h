@@ -31,7 +31,8 @@ typedef struct test_s {
 	const char *test_desc;
 	char test_id[65];
 	struct sockaddr_in sin;
-	int udp_fd;
+	int udp_fd;	/* the UDP socket, or the stream socket if `stream` */
+	int stream;	/* TADA_ADDR is tcp://HOST:PORT or unix://PATH */
 	char *log_path;
 	FILE *log_file;
 	int flags;
@@ -42,6 +43,7 @@ typedef struct test_s {
 #define TADA_FALSE	(1 == 0)
 #define TADAD_HOST	"localhost"
 #define TADAD_PORT	9862
+#define TADAD_ACK_TIMEOUT 30 /* seconds to wait for the test-finish ack */
 
 #define TEST_BEGIN(_suite_name, _test_name, _test_type, _test_user, \
 		   _commit_id, _test_desc, _log_path, _flags, c_name) \
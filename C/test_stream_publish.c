@@ -5,6 +5,7 @@
 #include <sys/stat.h>
 #include <stdarg.h>
 #include <sys/time.h>
+#include <time.h>
 #include <unistd.h>
 #include <getopt.h>
 #include <semaphore.h>
@@ -23,6 +24,10 @@ static struct option long_opts[] = {
 	{"auth",       required_argument, 0,  'a' },
 	{"auth_arg",   required_argument, 0,  'A' },
 	{"keep_alive", optional_argument, 0,  'k' },
+	{"count",      required_argument, 0,  'c' },
+	{"rate",       required_argument, 0,  'r' },
+	{"size",       required_argument, 0,  'z' },
+	{"timestamps", required_argument, 0,  'T' },
 	{0,            0,                 0,  0 }
 };
 
@@ -30,12 +35,24 @@ void usage(int argc, char **argv)
 {
 	printf("usage: %s -x <xprt> -h <host> -p <port> "
 	       "-s <stream-name> -t <stream-type> "
-	       "-f <file> -a <auth> -A <auth-opt>\n",
-	       argv[0]);
+	       "-f <file> -a <auth> -A <auth-opt>\n"
+	       "       %s -x <xprt> -h <host> -p <port> "
+	       "-s <stream-name> -t <stream-type> "
+	       "-c <count> [-r <rate>] [-z <size>] [-T <timestamps-file>]\n"
+	       "\n"
+	       "The second form is the throughput mode. It publishes <count>\n"
+	       "generated messages of <size> bytes (default: 1024) over a single\n"
+	       "connection at <rate> messages/sec (default: 0, unlimited).\n"
+	       "Each message starts with its sequence number and send time,\n"
+	       "i.e. '{\"seq\":SEQ,\"ts\":TS,\"pad\":\"xx...\"}' (json) or\n"
+	       "'SEQ TS xx...' (string). The send time of each message is\n"
+	       "recorded as 'SEQ TS' lines in <timestamps-file> if given. The\n"
+	       "summary is printed to stdout in JSON format.\n",
+	       argv[0], argv[0]);
 	exit(1);
 }
 
-static const char *short_opts = "h:p:f:s:t:x:a:A:v";
+static const char *short_opts = "h:p:f:s:t:x:a:A:vc:r:z:T:";
 
 #define AUTH_OPT_MAX 128
 #define KEEP_ALIVE_US 100000
@@ -110,6 +127,89 @@ static int stream_publish_file(const char *stream, const char *type,
 	return rc;
 }
 
+static double now_ts(void)
+{
+	struct timespec ts;
+	clock_gettime(CLOCK_REALTIME, &ts);
+	return ts.tv_sec + ts.tv_nsec / 1e9;
+}
+
+/* Fill `buf` with message `seq` of `size` bytes sent at `ts` */
+static size_t bench_msg(char *buf, size_t size, int is_json, long seq, double ts)
+{
+	size_t len;
+	const char *tail = is_json ? "\"}" : "";
+	size_t tail_len = strlen(tail);
+
+	if (is_json)
+		len = sprintf(buf, "{\"seq\":%ld,\"ts\":%.6f,\"pad\":\"", seq, ts);
+	else
+		len = sprintf(buf, "%ld %.6f ", seq, ts);
+	if (len + tail_len < size) {
+		memset(&buf[len], 'x', size - len - tail_len);
+		len = size - tail_len;
+	}
+	memcpy(&buf[len], tail, tail_len);
+	len += tail_len;
+	buf[len] = 0;
+	return len;
+}
+
+static int stream_publish_bench(const char *stream, const char *type,
+				ldms_t x, long count, double rate, size_t size,
+				FILE *ts_file)
+{
+	int rc;
+	int is_json;
+	long i, errors = 0;
+	size_t len, bytes = 0;
+	double t0, t1, t, dt;
+	char *buf;
+
+	if (0 == strcasecmp("json", type))
+		is_json = 1;
+	else if (0 == strcasecmp("string", type))
+		is_json = 0;
+	else
+		return EINVAL;
+
+	buf = malloc(size + 128);
+	if (!buf) {
+		printf("Error allocating %ld bytes of memory\n", size + 128);
+		return ENOMEM;
+	}
+
+	t0 = now_ts();
+	for (i = 0; i < count; i++) {
+		if (rate > 0) {
+			dt = t0 + i / rate - now_ts();
+			if (dt > 0)
+				usleep(dt * 1e6);
+		}
+		t = now_ts();
+		len = bench_msg(buf, size, is_json, i, t);
+		rc = ldmsd_stream_publish(x, stream, is_json ? LDMSD_STREAM_JSON :
+					  LDMSD_STREAM_STRING, buf, len);
+		if (rc) {
+			errors++;
+			continue;
+		}
+		bytes += len;
+		if (ts_file)
+			fprintf(ts_file, "%ld %.6f\n", i, t);
+	}
+	t1 = now_ts();
+	if (ts_file)
+		fclose(ts_file);
+	free(buf);
+	printf("{\"sent\":%ld,\"errors\":%ld,\"bytes\":%ld,\"size\":%ld,"
+	       "\"type\":\"%s\",\"start\":%.6f,\"end\":%.6f,"
+	       "\"msgs_per_sec\":%.3f,\"bytes_per_sec\":%.3f}\n",
+	       count - errors, errors, bytes, size, type, t0, t1,
+	       (count - errors) / (t1 - t0), bytes / (t1 - t0));
+	return 0;
+}
+
 int main(int argc, char **argv)
 {
 	int rc;
@@ -127,6 +227,11 @@ int main(int argc, char **argv)
 	FILE *file;
 	const char *stream_type = "string";
 	ldms_t x;
+	long count = 0;
+	double rate = 0;
+	size_t size = 1024;
+	char *ts_path = NULL;
+	FILE *ts_file = NULL;
 
 	auth_opt = av_new(auth_opt_max);
 	if (!auth_opt) {
@@ -208,6 +313,22 @@ int main(int argc, char **argv)
 		case 'k':
 			keep_alive_us = atoi(optarg);
 			break;
+		case 'c':
+			count = atol(optarg);
+			break;
+		case 'r':
+			rate = atof(optarg);
+			break;
+		case 'z':
+			size = atol(optarg);
+			break;
+		case 'T':
+			ts_path = strdup(optarg);
+			if (!ts_path) {
+				printf("ERROR: out of memory\n");
+				exit(1);
+			}
+			break;
 		default:
 			usage(argc, argv);
 		}
@@ -215,7 +336,16 @@ int main(int argc, char **argv)
 	if (!host || !port || !stream)
 		usage(argc, argv);
 
-	if (filename)
+	if (count) {
+		file = NULL;
+		if (ts_path) {
+			ts_file = fopen(ts_path, "w");
+			if (!ts_file) {
+				printf("Error %d opening '%s'\n", errno, ts_path);
+				exit(1);
+			}
+		}
+	} else if (filename)
 		file = fopen(filename, "r");
 	else
 		file = stdin;
@@ -242,7 +372,11 @@ int main(int argc, char **argv)
 		exit(1);
 	}
 
-	rc = stream_publish_file(stream, stream_type, x, file);
+	if (count)
+		rc = stream_publish_bench(stream, stream_type, x, count, rate,
+					  size, ts_file);
+	else
+		rc = stream_publish_file(stream, stream_type, x, file);
 	if (rc) {
 		printf("Error %d sending stream\n", rc);
 		exit(1);
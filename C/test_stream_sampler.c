@@ -82,11 +82,16 @@ static char tada_user[64]; /* populated in get_plugin */
 
 static ldmsd_msg_log_f msglog;
 static char *stream;
+static int count_mode; /* mode=count */
+static int subscribed;
 
 static const char *usage(struct ldmsd_plugin *self)
 {
 	return  "config name=test_stream_sampler path=<path> port=<port_no> log=<path>\n"
-		"     output    The path to a file to dump stream output to.\n";
+		"     output    The path to a file to dump stream output to.\n"
+		"     mode      'dump' (default) to dump the stream contents, or\n"
+		"               'count' to write the message counters and the\n"
+		"               delivery latency summary (JSON) instead.\n";
 }
 
 static ldms_set_t get_set(struct ldmsd_sampler *self)
@@ -106,32 +111,202 @@ static int test_stream_recv_cb(ldmsd_stream_client_t c, void *ctxt,
 
 FILE *out = NULL;
 
+/* ============== Counter mode (mode=count) ================= */
+/*
+ * In the counter mode, the messages are not dumped. Instead, the messages
+ * generated by `test_stream_publish -c COUNT` (which start with the sequence
+ * number and the send time) are counted, and the summary is rewritten to the
+ * output file as a JSON object every 0.5 seconds (and at termination):
+ *
+ * {"msgs":N,"bytes":B,"first":T0,"last":T1,"seq_max":S,"out_of_order":O,
+ *  "parse_errors":E,"lat_sum":L,"lat_max":M,"lat_hist":[...]}
+ *
+ * T0 and T1 are the receive time of the first and the last messages. The
+ * delivery latency (receive time - send time) is in seconds, and
+ * lat_hist[i] is the number of messages with latency < 2^i micro seconds
+ * (and >= 2^(i-1)).
+ */
+#define LAT_BUCKETS 32
+#define COUNTER_DUMP_US 500000
+
+struct tss_counter {
+	pthread_mutex_t mutex;
+	pthread_t thread;
+	int stop;
+	FILE *out;
+	uint64_t msgs, bytes, out_of_order, parse_errors;
+	int64_t seq_max;
+	double first, last;
+	double lat_sum, lat_max;
+	uint64_t lat_hist[LAT_BUCKETS];
+};
+
+static double counter_now(void)
+{
+	struct timespec ts;
+	clock_gettime(CLOCK_REALTIME, &ts);
+	return ts.tv_sec + ts.tv_nsec / 1e9;
+}
+
+static void counter_recv(struct tss_counter *ctr,
+			 ldmsd_stream_type_t stream_type,
+			 const char *msg, size_t msg_len)
+{
+	char head[64];
+	int64_t seq;
+	double ts, lat, now = counter_now();
+	int n, b;
+	uint64_t usec;
+
+	n = msg_len < sizeof(head) - 1 ? msg_len : sizeof(head) - 1;
+	memcpy(head, msg, n);
+	head[n] = 0;
+	if (stream_type == LDMSD_STREAM_JSON)
+		n = sscanf(head, "{\"seq\":%ld,\"ts\":%lf", &seq, &ts);
+	else
+		n = sscanf(head, "%ld %lf", &seq, &ts);
+
+	pthread_mutex_lock(&ctr->mutex);
+	if (!ctr->msgs)
+		ctr->first = now;
+	ctr->last = now;
+	ctr->msgs++;
+	ctr->bytes += msg_len;
+	if (n != 2) {
+		ctr->parse_errors++;
+		goto out;
+	}
+	if (seq < ctr->seq_max)
+		ctr->out_of_order++;
+	else
+		ctr->seq_max = seq;
+	lat = now - ts;
+	ctr->lat_sum += lat;
+	if (lat > ctr->lat_max)
+		ctr->lat_max = lat;
+	usec = lat > 0 ? (uint64_t)(lat * 1e6) : 0;
+	for (b = 0; b < LAT_BUCKETS - 1 && (1ULL << b) <= usec; b++)
+		;
+	ctr->lat_hist[b]++;
+ out:
+	pthread_mutex_unlock(&ctr->mutex);
+}
+
+/* must hold ctr->mutex */
+static void counter_dump(struct tss_counter *ctr)
+{
+	int i;
+	rewind(ctr->out);
+	if (ftruncate(fileno(ctr->out), 0))
+		return;
+	fprintf(ctr->out, "{\"msgs\":%lu,\"bytes\":%lu,\"first\":%.6f,"
+		"\"last\":%.6f,\"seq_max\":%ld,\"out_of_order\":%lu,"
+		"\"parse_errors\":%lu,\"lat_sum\":%.6f,\"lat_max\":%.6f,"
+		"\"lat_hist\":[",
+		ctr->msgs, ctr->bytes, ctr->first, ctr->last, ctr->seq_max,
+		ctr->out_of_order, ctr->parse_errors, ctr->lat_sum,
+		ctr->lat_max);
+	for (i = 0; i < LAT_BUCKETS; i++)
+		fprintf(ctr->out, "%s%lu", i ? "," : "", ctr->lat_hist[i]);
+	fprintf(ctr->out, "]}\n");
+	fflush(ctr->out);
+}
+
+static void *counter_thread(void *arg)
+{
+	struct tss_counter *ctr = arg;
+	while (!ctr->stop) {
+		usleep(COUNTER_DUMP_US);
+		pthread_mutex_lock(&ctr->mutex);
+		counter_dump(ctr);
+		pthread_mutex_unlock(&ctr->mutex);
+	}
+	return NULL;
+}
+
+static int counter_start(struct tss_counter *ctr, FILE *out)
+{
+	int rc;
+	memset(ctr, 0, sizeof(*ctr));
+	pthread_mutex_init(&ctr->mutex, NULL);
+	ctr->out = out;
+	ctr->seq_max = -1;
+	rc = pthread_create(&ctr->thread, NULL, counter_thread, ctr);
+	if (rc)
+		ctr->out = NULL; /* not started, nothing to stop */
+	return rc;
+}
+
+static void counter_stop(struct tss_counter *ctr)
+{
+	if (!ctr->out)
+		return;
+	ctr->stop = 1;
+	pthread_join(ctr->thread, NULL);
+	pthread_mutex_lock(&ctr->mutex);
+	counter_dump(ctr);
+	pthread_mutex_unlock(&ctr->mutex);
+	ctr->out = NULL;
+}
+
+static struct tss_counter counter;
+
 static int config(struct ldmsd_plugin *self, struct attr_value_list *kwl, struct attr_value_list *avl)
 {
 	char *value;
-	int rc;
+	FILE *f;
+	int rc, mode;
 
+	if (out) {
+		ldmsd_log(LDMSD_LERROR, "test_stream_sampler: "
+			  "already configured, `term` it first\n");
+		return EBUSY;
+	}
 	value = av_value(avl, "stream");
-	if (value)
+	if (!value)
+		value = "test_stream";
+	if (subscribed && strcmp(stream, value)) {
+		/* the subscription outlives `term`, and cannot be moved */
+		ldmsd_log(LDMSD_LERROR, "test_stream_sampler: "
+			  "already subscribed to stream '%s', "
+			  "cannot change it to '%s'\n", stream, value);
+		return EINVAL;
+	}
+	if (!subscribed) {
+		/* re-config after term reuses the subscription */
 		stream = strdup(value);
-	else
-		stream = strdup("test_stream");
-	ldmsd_stream_subscribe(stream, test_stream_recv_cb, self);
+		if (!stream)
+			return ENOMEM;
+		ldmsd_stream_subscribe(stream, test_stream_recv_cb, self);
+		subscribed = 1;
+	}
+	value = av_value(avl, "mode");
+	mode = value && 0 == strcmp(value, "count");
 
 	value = av_value(avl, "output");
 	if (!value)
 		value = "/data/test_stream_sampler.out";
-	out = fopen(value, "w");
-	if (!out) {
+	f = fopen(value, "w");
+	if (!f) {
 		rc = errno;
 		ldmsd_log(LDMSD_LERROR, "test_stream_sampler: "
 			  "cannot open file '%s'\n", value);
+		return rc;
+	}
+	if (mode) {
+		rc = counter_start(&counter, f);
+		if (rc) {
+			fclose(f);
+			return rc;
+		}
 	} else {
-		rc = 0;
-		setbuf(out, NULL); /* no buffer */
+		setbuf(f, NULL); /* no buffer */
 	}
-
-	return rc;
+	/* `out` tells the receive callback that we are ready, so it is set
+	 * only after the counter is initialized. */
+	count_mode = mode;
+	__atomic_store_n(&out, f, __ATOMIC_RELEASE);
+	return 0;
 }
 
 static int test_stream_recv_cb(ldmsd_stream_client_t c, void *ctxt,
@@ -143,6 +318,12 @@ static int test_stream_recv_cb(ldmsd_stream_client_t c, void *ctxt,
 	char soh = 1; /* start of heading */
 	char stx = 2; /* start of text */
 	char etx = 3; /* end of text */
+	if (!__atomic_load_n(&out, __ATOMIC_ACQUIRE))
+		return 0;
+	if (count_mode) {
+		counter_recv(&counter, stream_type, msg, msg_len);
+		return 0;
+	}
 	fwrite(&soh, 1, 1, out);
 	switch (stream_type) {
 	case LDMSD_STREAM_STRING:
@@ -164,6 +345,8 @@ static int test_stream_recv_cb(ldmsd_stream_client_t c, void *ctxt,
 static void term(struct ldmsd_plugin *self)
 {
 	if (out) {
+		if (count_mode)
+			counter_stop(&counter);
 		fclose(out);
 		out = NULL;
 	}
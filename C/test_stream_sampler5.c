@@ -53,13 +53,18 @@
  * test_stream_sampler for LDMSD v5.
  *
  * The sampler registers for the given ldmsd stream and dumps the stream
- * contents to the given output file.
+ * contents to the given output file, or only counts the messages (mode=count).
  *
  * This sampler does NOT create LDMS sets. It also does NOT need `smplr` to
  * periodically update.
  */
 
 #include <stdio.h>
+#include <stdint.h>
+#include <string.h>
+#include <unistd.h>
+#include <time.h>
+#include <pthread.h>
 
 #include "ldms/ldmsd.h"
 #include "ldms/ldmsd_sampler.h"
@@ -70,6 +75,144 @@
 		ldmsd_log((lvl), "%s: " fmt, INST(inst)->inst_name, \
 								##__VA_ARGS__)
 
+/* ============== Counter mode (mode=count) ================= */
+/*
+ * In the counter mode, the messages are not dumped. Instead, the messages
+ * generated by `test_stream_publish -c COUNT` (which start with the sequence
+ * number and the send time) are counted, and the summary is rewritten to the
+ * output file as a JSON object every 0.5 seconds (and at termination):
+ *
+ * {"msgs":N,"bytes":B,"first":T0,"last":T1,"seq_max":S,"out_of_order":O,
+ *  "parse_errors":E,"lat_sum":L,"lat_max":M,"lat_hist":[...]}
+ *
+ * T0 and T1 are the receive time of the first and the last messages. The
+ * delivery latency (receive time - send time) is in seconds, and
+ * lat_hist[i] is the number of messages with latency < 2^i micro seconds
+ * (and >= 2^(i-1)).
+ */
+#define LAT_BUCKETS 32
+#define COUNTER_DUMP_US 500000
+
+struct tss_counter {
+	pthread_mutex_t mutex;
+	pthread_t thread;
+	int stop;
+	FILE *out;
+	uint64_t msgs, bytes, out_of_order, parse_errors;
+	int64_t seq_max;
+	double first, last;
+	double lat_sum, lat_max;
+	uint64_t lat_hist[LAT_BUCKETS];
+};
+
+static double counter_now(void)
+{
+	struct timespec ts;
+	clock_gettime(CLOCK_REALTIME, &ts);
+	return ts.tv_sec + ts.tv_nsec / 1e9;
+}
+
+static void counter_recv(struct tss_counter *ctr,
+			 ldmsd_stream_type_t stream_type,
+			 const char *msg, size_t msg_len)
+{
+	char head[64];
+	int64_t seq;
+	double ts, lat, now = counter_now();
+	int n, b;
+	uint64_t usec;
+
+	n = msg_len < sizeof(head) - 1 ? msg_len : sizeof(head) - 1;
+	memcpy(head, msg, n);
+	head[n] = 0;
+	if (stream_type == LDMSD_STREAM_JSON)
+		n = sscanf(head, "{\"seq\":%ld,\"ts\":%lf", &seq, &ts);
+	else
+		n = sscanf(head, "%ld %lf", &seq, &ts);
+
+	pthread_mutex_lock(&ctr->mutex);
+	if (!ctr->msgs)
+		ctr->first = now;
+	ctr->last = now;
+	ctr->msgs++;
+	ctr->bytes += msg_len;
+	if (n != 2) {
+		ctr->parse_errors++;
+		goto out;
+	}
+	if (seq < ctr->seq_max)
+		ctr->out_of_order++;
+	else
+		ctr->seq_max = seq;
+	lat = now - ts;
+	ctr->lat_sum += lat;
+	if (lat > ctr->lat_max)
+		ctr->lat_max = lat;
+	usec = lat > 0 ? (uint64_t)(lat * 1e6) : 0;
+	for (b = 0; b < LAT_BUCKETS - 1 && (1ULL << b) <= usec; b++)
+		;
+	ctr->lat_hist[b]++;
+ out:
+	pthread_mutex_unlock(&ctr->mutex);
+}
+
+/* must hold ctr->mutex */
+static void counter_dump(struct tss_counter *ctr)
+{
+	int i;
+	rewind(ctr->out);
+	if (ftruncate(fileno(ctr->out), 0))
+		return;
+	fprintf(ctr->out, "{\"msgs\":%lu,\"bytes\":%lu,\"first\":%.6f,"
+		"\"last\":%.6f,\"seq_max\":%ld,\"out_of_order\":%lu,"
+		"\"parse_errors\":%lu,\"lat_sum\":%.6f,\"lat_max\":%.6f,"
+		"\"lat_hist\":[",
+		ctr->msgs, ctr->bytes, ctr->first, ctr->last, ctr->seq_max,
+		ctr->out_of_order, ctr->parse_errors, ctr->lat_sum,
+		ctr->lat_max);
+	for (i = 0; i < LAT_BUCKETS; i++)
+		fprintf(ctr->out, "%s%lu", i ? "," : "", ctr->lat_hist[i]);
+	fprintf(ctr->out, "]}\n");
+	fflush(ctr->out);
+}
+
+static void *counter_thread(void *arg)
+{
+	struct tss_counter *ctr = arg;
+	while (!ctr->stop) {
+		usleep(COUNTER_DUMP_US);
+		pthread_mutex_lock(&ctr->mutex);
+		counter_dump(ctr);
+		pthread_mutex_unlock(&ctr->mutex);
+	}
+	return NULL;
+}
+
+static int counter_start(struct tss_counter *ctr, FILE *out)
+{
+	int rc;
+	memset(ctr, 0, sizeof(*ctr));
+	pthread_mutex_init(&ctr->mutex, NULL);
+	ctr->out = out;
+	ctr->seq_max = -1;
+	rc = pthread_create(&ctr->thread, NULL, counter_thread, ctr);
+	if (rc)
+		ctr->out = NULL; /* not started, nothing to stop */
+	return rc;
+}
+
+static void counter_stop(struct tss_counter *ctr)
+{
+	if (!ctr->out)
+		return;
+	ctr->stop = 1;
+	pthread_join(ctr->thread, NULL);
+	pthread_mutex_lock(&ctr->mutex);
+	counter_dump(ctr);
+	pthread_mutex_unlock(&ctr->mutex);
+	ctr->out = NULL;
+}
+
 typedef struct tss_inst_s *tss_inst_t;
 struct tss_inst_s {
 	struct ldmsd_plugin_inst_s base;
@@ -78,6 +221,8 @@ struct tss_inst_s {
 	char *stream;
 	FILE *out;
 	ldmsd_stream_client_t stream_client;
+	int count_mode; /* mode=count */
+	struct tss_counter counter;
 };
 
 /* ============== Sampler Plugin APIs ================= */
@@ -108,12 +253,15 @@ const char *tss_desc(ldmsd_plugin_inst_t pi)
 static
 char *_help = "\
 test_stream_sampler configuration synopsis:\n\
-    config name=INST stream=STREAM_NAME output=OUTPUT_PATH\n\
+    config name=INST stream=STREAM_NAME output=OUTPUT_PATH [mode=dump|count]\n\
 \n\
 Option descriptions:\n\
     stream The name of the ldmsd stream to register to. (default: test_stream)\n\
     output The path of output file for dumping stream contents.\n\
            (default: /data/test_stream_sampler.out)\n\
+    mode   'dump' (default) to dump the stream contents, or 'count' to write\n\
+           the message counters and the delivery latency summary (JSON)\n\
+           instead.\n\
 ";
 
 static
@@ -132,6 +280,12 @@ int test_stream_recv_cb(ldmsd_stream_client_t c, void *ctxt,
 	char soh = 1; /* start of heading */
 	char stx = 2; /* start of text */
 	char etx = 3; /* end of text */
+	if (!inst->out)
+		return 0;
+	if (inst->count_mode) {
+		counter_recv(&inst->counter, stream_type, msg, msg_len);
+		return 0;
+	}
 	fwrite(&soh, 1, 1, inst->out);
 	switch (stream_type) {
 	case LDMSD_STREAM_STRING:
@@ -167,37 +321,57 @@ int tss_config(ldmsd_plugin_inst_t pi, json_entity_t json,
 	ldmsd_sampler_type_t samp = (void*)inst->base.base;
 	int rc;
 	const char *value;
+	FILE *f;
 
 	rc = samp->base.config(pi, json, ebuf, ebufsz);
 	if (rc)
 		return rc;
 
 
+	if (inst->out) {
+		/* the receive callback may be using the output and the counter */
+		snprintf(ebuf, ebufsz, "already configured, "
+			 "delete the instance to reconfigure it");
+		return EBUSY;
+	}
+
 	value = json_attr_find_str(json, "stream");
-	if (value)
-		inst->stream = strdup(value);
-	else
-		inst->stream = strdup("test_stream");
+	if (!value)
+		value = "test_stream";
+	free(inst->stream);
+	inst->stream = strdup(value);
+	if (!inst->stream)
+		return ENOMEM;
+	value = json_attr_find_str(json, "mode");
+	inst->count_mode = value && 0 == strcmp(value, "count");
 	value = json_attr_find_str(json, "output");
 	if (!value)
 		value = "/data/test_stream_sampler.out";
-	inst->out = fopen(value, "w");
-	if (!inst->out) {
+	f = fopen(value, "w");
+	if (!f) {
 		rc = errno;
 		ldmsd_log(LDMSD_LERROR, "test_stream_sampler: "
 			  "cannot open file '%s'\n", value);
+		return rc;
+	}
+	if (inst->count_mode) {
+		rc = counter_start(&inst->counter, f);
+		if (rc) {
+			fclose(f);
+			return rc;
+		}
 	} else {
-		rc = 0;
-		setbuf(inst->out, NULL); /* no buffer */
+		setbuf(f, NULL); /* no buffer */
 	}
+	/* set `out` only after the counter is initialized */
+	inst->out = f;
 
 	inst->stream_client = ldmsd_stream_subscribe(inst->stream,
 						     test_stream_recv_cb, inst);
-
 	if (!inst->stream_client)
-		rc = errno;
+		return errno;
 
-	return rc;
+	return 0;
 }
 
 static
@@ -208,6 +382,9 @@ void tss_del(ldmsd_plugin_inst_t pi)
 	if (inst->stream_client)
 		ldmsd_stream_close(inst->stream_client);
 
+	if (inst->count_mode)
+		counter_stop(&inst->counter);
+
 	if (inst->out)
 		fclose(inst->out);
 
@@ -5,11 +5,20 @@ import pwd
 import glob
 import time
 import json
+import base64
 import errno
+import tarfile
+import calendar
+import shlex
 import socket
+import struct
+import hashlib
 import docker
 import ipaddress as ip
+import logging
+import threading
 import subprocess
+import concurrent.futures
 
 import TADA
 
@@ -22,6 +31,8 @@ from distutils.spawn import find_executable
 
 from functools import reduce
 
+log = logging.getLogger(__name__)
+
 # `D` Debug object to store values for debugging
 class Debug(object): pass
 D = Debug()
@@ -266,6 +277,196 @@ def get_docker_clients():
     return [ docker.DockerClient(base_url = "tcp://{}:2375".format(a)) \
                     for a in addrs ]
 
+def parallel_map(fn, items, max_workers = None):
+    """Concurrently apply `fn` to each item in `items` using threads
+
+    Returns the list of results in the order of `items`. If `fn` raised an
+    exception, the exception is re-raised after all calls are finished.
+    """
+    items = list(items)
+    if not items:
+        return []
+    with concurrent.futures.ThreadPoolExecutor(
+                    max_workers = max_workers or len(items)) as ex:
+        futures = [ ex.submit(fn, item) for item in items ]
+    return [ f.result() for f in futures ]
+
+def write_file_cmd(path, content):
+    """A shell command writing `content` into `path` (e.g. a snapshot setup)
+
+    The content is base64-encoded in the command so that it needs no quoting.
+    """
+    if type(content) == str:
+        content = content.encode()
+    return "/bin/bash -c 'mkdir -p {d} && echo {b64} | base64 -d > {p}'" \
+           .format(d = os.path.dirname(path), p = path,
+                   b64 = base64.b64encode(content).decode())
+
+def fan_out(fn, items, max_workers = 16):
+    """Concurrently apply `fn` to `items`, yielding results as they complete
+
+    A generator of (item, result, exc) in the order of completion, where
+    `exc` is the exception raised by `fn(item)` (`result` is then `None`).
+    At most `max_workers` calls run at the same time.
+    """
+    items = list(items)
+    if not items:
+        return
+    with concurrent.futures.ThreadPoolExecutor(
+                    max_workers = min(max_workers, len(items))) as ex:
+        futures = { ex.submit(fn, item): item for item in items }
+        for f in concurrent.futures.as_completed(futures):
+            exc = f.exception()
+            yield futures[f], (None if exc else f.result()), exc
+
+_HOST_NUM_RE = re.compile(r'^(.*?)(\d+)$')
+
+def hostlist_compress(names):
+    """Compress hostnames into a hostlist expression
+
+    Example
+    -------
+    >>> hostlist_compress(["node-1", "node-2", "node-3", "node-5", "headnode"])
+    'headnode,node-[1-3,5]'
+    """
+    groups = dict() # (prefix, width) : [ numbers ]
+    plain = set()
+    for name in names:
+        m = _HOST_NUM_RE.match(name)
+        if not m:
+            plain.add(name)
+            continue
+        prefix, num = m.groups()
+        width = len(num) if num.startswith("0") and len(num) > 1 else 0
+        groups.setdefault((prefix, width), set()).add(int(num))
+    exprs = [ (n, n) for n in plain ]
+    for (prefix, width), nums in groups.items():
+        nums = sorted(nums)
+        ranges = []
+        for n in nums:
+            if ranges and ranges[-1][1] == n - 1:
+                ranges[-1][1] = n
+            else:
+                ranges.append([n, n])
+        fmt = lambda n: str(n).zfill(width)
+        rtxt = ",".join( fmt(a) if a == b else "{}-{}".format(fmt(a), fmt(b)) \
+                         for a, b in ranges )
+        if len(nums) == 1:
+            exprs.append( (prefix, prefix + rtxt) )
+        else:
+            exprs.append( (prefix, "{}[{}]".format(prefix, rtxt)) )
+    return ",".join( e for k, e in sorted(exprs) )
+
+def dshbak(results):
+    """Group identical outputs (like `dshbak -c`)
+
+    Parameters
+    ----------
+    results : dict
+        { HOSTNAME : OUTPUT }, where OUTPUT is any comparable value, e.g. the
+        (rc, output) of `exec_run()`.
+
+    Returns
+    -------
+    [ (HOSTLIST, OUTPUT), ... ]
+        HOSTLIST is the compressed hostnames (see `hostlist_compress()`) having
+        the same OUTPUT.
+    """
+    groups = dict()
+    for host, out in results.items():
+        groups.setdefault(out, []).append(host)
+    return sorted( (hostlist_compress(hosts), out) \
+                   for out, hosts in groups.items() )
+
+def dshbak_format(results):
+    """Format `dshbak(results)` as text, a header for each host group"""
+    sio = StringIO()
+    for hosts, out in dshbak(results):
+        if type(out) == tuple and len(out) == 2: # (rc, output)
+            hdr = "{} (rc: {})".format(hosts, out[0])
+            out = out[1]
+        else:
+            hdr = hosts
+        sio.write("-"*16 + "\n" + hdr + "\n" + "-"*16 + "\n")
+        sio.write(str(out))
+        if not str(out).endswith("\n"):
+            sio.write("\n")
+    return sio.getvalue()
+
+def wait_until(predicate, timeout = 30, backoff = 1.5, interval = 0.1,
+               max_interval = 2.0, desc = None):
+    """Poll `predicate()` until it returns a true value or `timeout` expires
+
+    The polling interval starts at `interval` seconds and is multiplied by
+    `backoff` after each unsatisfied poll (capped at `max_interval`). An
+    exception raised by `predicate` counts as an unsatisfied poll. The time the
+    wait took is logged with `desc` (default: the name of the predicate).
+
+    Example
+    -------
+    >>> wait_until(lambda: cont.ldmsd_listening(), timeout = 10)
+
+    Returns
+    -------
+    float
+        The elapsed time (seconds) if `predicate` is satisfied.
+    None
+        If `timeout` expired.
+    """
+    desc = desc if desc else getattr(predicate, "__name__", str(predicate))
+    t0 = time.time()
+    while True:
+        try:
+            ok = predicate()
+        except Exception:
+            ok = False
+        dt = time.time() - t0
+        if ok:
+            log.info("wait `{}`: satisfied in {:.3f} sec".format(desc, dt))
+            return dt
+        if dt >= timeout:
+            log.warning("wait `{}`: timeout ({} sec)".format(desc, timeout))
+            return None
+        time.sleep(min(interval, timeout - dt))
+        interval = min(interval * backoff, max_interval)
+
+def percentiles(values, ps = (50, 95, 99)):
+    """Summary statistics of `values` (a list of numbers)
+
+    Returns a dict with "count", "min", "mean", "max" and "pNN" for each `NN`
+    in `ps` (nearest-rank percentiles), e.g. { "count": 100, "min": 0.1,
+    "mean": 0.3, "max": 1.2, "p50": 0.25, "p95": 0.8, "p99": 1.1 }. The values
+    are `None` if `values` is empty.
+    """
+    v = sorted(values)
+    n = len(v)
+    ret = { "count": n,
+            "min": v[0] if n else None,
+            "mean": sum(v) / n if n else None,
+            "max": v[-1] if n else None }
+    for p in ps:
+        ret["p{}".format(p)] = v[max(0, -(-p * n // 100) - 1)] if n else None
+    return ret
+
+def log2_hist_percentile(hist, p, unit = 1e-6):
+    """The upper bound of the bucket at the `p` percentile of a log2 histogram
+
+    `hist[i]` is the number of values in [2^(i-1), 2^i) `unit`s (e.g. the
+    `lat_hist` of `test_stream_sampler` in the counter mode). Returns the upper
+    bound `2^i * unit` of the bucket containing the `p` percentile, or `None`
+    if the histogram is empty.
+    """
+    n = sum(hist)
+    if not n:
+        return None
+    rank = max(1, -(-p * n // 100))
+    acc = 0
+    for i, c in enumerate(hist):
+        acc += c
+        if acc >= rank:
+            return (1 << i) * unit
+    return None
+
 def jprint(obj):
     """Pretty print JSON object"""
     print(json.dumps(obj, indent=2))
@@ -292,16 +493,16 @@ def guess_ovis_prefix():
         prefix = "/opt/ovis"
     return prefix
 
-ADDR_RE = re.compile(r'^(?P<addr>[^:]+)(?:[:](?P<port>\d+))?$')
 def tada_addr(s):
-    m = ADDR_RE.match(s)
-    if not m:
-        raise ValueError("Bad address format")
-    m = m.groupdict()
-    if m["port"]:
-        return s # already has port specified
-    else:
-        return s + ":9862" # default port
+    """Validate `--tada-addr` ([udp://|tcp://]HOST[:PORT] or unix://PATH)
+
+    Returns the address with the port (default: 9862).
+    """
+    xprt, host, port = TADA.parse_tada_addr(s) # ValueError if bad format
+    if xprt == "unix":
+        return s
+    scheme = xprt + "://" if "://" in s else ""
+    return "{}{}:{}".format(scheme, host, port)
 
 def get_cluster_name(parsed_args):
     """Derive `clustername` from the parsed CLI arguments"""
@@ -333,10 +534,16 @@ def add_common_args(parser):
             help = "The path to host db directory. The default is "
                    "'/home/{user}/db/{clustername}'" )
     parser.add_argument("--tada_addr", "--tada-addr", type=tada_addr,
-            help="The test automation server host and port as host:port.",
+            help="The test automation server host and port as host:port. "
+                 "Use tcp://host:port or unix://path for the stream "
+                 "transport instead of UDP.",
             default="tada-host:9862")
     parser.add_argument("--debug", action="store_true",
             help="Turn on TADA.DEBUG flag.")
+    parser.add_argument("--tada-buffered", action="store_true",
+            help="Send the TADA messages in batches (TADA.BUFFERED) instead "
+                 "of one by one, and keep a copy of them in the data root "
+                 "for `tadad --ingest` (TADA.SPOOL_DIR).")
     parser.add_argument("--mount", action="append",
             metavar = "SRC:DST[:MODE]", default = [],
             help="Add additional mount point to the container. "
@@ -356,6 +563,10 @@ def process_args(parsed_args):
     args.commit_id = get_ovis_commit_id(args.prefix)
     if args.debug:
         TADA.DEBUG = True
+    if args.tada_buffered:
+        TADA.BUFFERED = True
+        # keep a copy of the TADA messages for `tadad --ingest`
+        TADA.SPOOL_DIR = args.data_root
 
 DEEP_COPY_TBL = {
         dict: lambda x: { k:deep_copy(v) for k,v in x.items() },
@@ -593,7 +804,21 @@ class Spec(dict):
         return _ret
 
     def _subst_str(self, val):
-        return self.VAR_RE.sub(lambda m: str(self.VAR[m.group(1)]), val)
+        return self.subst_vars(val, self.VAR)
+
+    @classmethod
+    def scope_vars(cls, *objs):
+        """The %VAR% dict of the nested `objs` (outermost first)"""
+        var = dict()
+        for obj in objs:
+            var.update( { k:v for k,v in obj.items() \
+                              if type(v) in cls.PRIMITIVES } )
+        return var
+
+    @classmethod
+    def subst_vars(cls, val, var):
+        """Substitute %VAR% in the string `val` with the values in `var`"""
+        return cls.VAR_RE.sub(lambda m: str(var[m.group(1)]), val)
 
 
 #####################################################
@@ -721,6 +946,42 @@ class Container(object):
         if ret != "true":
             raise RuntimeError(ret)
 
+    def put_archive(self, path, data):
+        """Extract the tar archive `data` (bytes) into `path` in the container
+        """
+        self.wait_running()
+        if not self.obj.put_archive(path, data):
+            raise RuntimeError("put_archive to '{}' failed".format(path))
+
+    def write_files(self, files, mode = 0o644):
+        """Write multiple files in a single transfer
+
+        Parameters
+        ----------
+        files : dict
+            { PATH : CONTENT } where PATH is the absolute path of the file in
+            the container and CONTENT is `str` or `bytes`. The parent
+            directories are created if needed.
+        mode : int
+            The file mode (default: 0o644). A `(CONTENT, MODE)` tuple in
+            `files` overrides it for that file.
+        """
+        bio = BytesIO()
+        now = time.time()
+        with tarfile.open(fileobj = bio, mode = "w") as tar:
+            for path, content in files.items():
+                _mode = mode
+                if type(content) == tuple:
+                    content, _mode = content
+                if type(content) == str:
+                    content = content.encode()
+                info = tarfile.TarInfo(path.lstrip("/"))
+                info.size = len(content)
+                info.mode = _mode
+                info.mtime = now
+                tar.addfile(info, BytesIO(content))
+        self.put_archive("/", bio.getvalue())
+
     def read_file(self, path):
         """Read file specified by `path` from the container"""
         cmd = "cat {}".format(path)
@@ -1253,6 +1514,16 @@ class DockerCluster(object):
                 raise
             return cls.create(name = name, **kwargs)
 
+    @classmethod
+    def find(cls, match = ".*"):
+        """Returns a list of clusters with names matching `match` regex"""
+        exp = re.compile(match)
+        dc = docker.from_env()
+        nets = [ n for n in dc.networks.list() \
+                   if (n.attrs.get("Labels") or {}).get("DockerCluster") \
+                      and exp.match(n.name) ]
+        return [ cls(n) for n in nets ]
+
     def is_running(self):
         """Check if the service (all ) is running"""
         for cont in self.containers:
@@ -1279,8 +1550,8 @@ class DockerCluster(object):
         """Return a list of docker Containers of the virtual cluster"""
         our_conts = []
         clients = get_docker_clients()
-        for cl in clients:
-            conts = cl.containers.list(all=True)
+        for conts in parallel_map(lambda cl: cl.containers.list(all=True),
+                                  clients):
             for cont in conts:
                 if cont.attrs['NetworkSettings']['Networks'].get(self.net.name):
                     our_conts.append(cont)
@@ -1312,14 +1583,67 @@ class DockerCluster(object):
         txt = self.net.obj.attrs["Labels"]["node_aliases"]
         return json.loads(txt)
 
-    def remove(self):
-        """Remove the docker service and its network"""
-        for cont in self.containers:
+    def remove(self, retry = 5, max_workers = 8):
+        """Remove the containers and the network of the virtual cluster
+
+        The docker hosts are processed concurrently, and the containers of
+        each host are removed concurrently by up to `max_workers` threads.
+        The network is removed only after the containers are verified to be
+        gone (re-listed, up to `retry` times with backoff), so that the removal
+        does not fail on the endpoints that are still attached. The network
+        removal is also retried up to `retry` times.
+
+        Returns
+        -------
+        dict(containers = N, networks = N, time = SEC)
+            The resources reclaimed and the time spent.
+        """
+        t0 = time.time()
+        conts = self.get_containers()
+        total = len(conts)
+        delay = 0.5
+        cont_retry = retry
+        while True:
+            by_host = dict()
+            for cont in conts:
+                by_host.setdefault(cont.client.api.base_url, []).append(cont)
+            parallel_map(lambda c: self._remove_containers(c, max_workers),
+                         by_host.values())
+            conts = self.get_containers()
+            if not conts or not cont_retry:
+                break
+            cont_retry -= 1
+            time.sleep(delay)
+            delay *= 2
+        if conts:
+            raise RuntimeError("Cannot remove containers: {}, the network `{}` "
+                               "is not removed" \
+                    .format(", ".join(c.name for c in conts), self.net.name))
+        delay = 0.5
+        net_retry = retry
+        while True:
+            try:
+                self.net.remove()
+                break
+            except docker.errors.NotFound:
+                break
+            except docker.errors.APIError:
+                if not net_retry:
+                    raise
+                net_retry -= 1
+                time.sleep(delay)
+                delay *= 2
+        return dict(containers = total, networks = 1, time = time.time() - t0)
+
+    @staticmethod
+    def _remove_containers(conts, max_workers = 8):
+        """(private) Remove `conts` (all on the same docker host)"""
+        def _remove(cont):
             try:
                 cont.remove(force = True)
-            except:
-                pass
-        self.net.remove()
+            except docker.errors.APIError:
+                pass # not found, or removal in progress; verified by caller
+        parallel_map(_remove, conts, max_workers = max_workers)
 
     @property
     def labels(self):
@@ -1391,6 +1715,71 @@ class LDMSDContainer(DockerClusterContainer):
         rc, out = self.exec_run("pgrep -c ldmsd")
         return rc == 0
 
+    @property
+    def ldmsd_listen(self):
+        """(xprt, port, auth) of the first ldmsd listening endpoint"""
+        return self._ldmsd_listen(self.ldmsd_spec)
+
+    @staticmethod
+    def _ldmsd_listen(spec):
+        """(xprt, port, auth) of the first listening endpoint of ldmsd `spec`"""
+        _listen = spec.get("listen")
+        if _listen:
+            return ( _listen[0].get("xprt", "sock"),
+                     _listen[0].get("port", 10000),
+                     _listen[0].get("auth", "none") )
+        return ( spec.get("listen_xprt"), spec.get("listen_port"),
+                 spec.get("listen_auth") )
+
+    def ldmsd_listening(self, port = None):
+        """Predicate: ldmsd is listening on `port` (default: from spec)"""
+        if port is None:
+            xprt, port, auth = self.ldmsd_listen
+        rc, out = self.exec_run("ss -ltn")
+        if rc:
+            return False
+        suffix = ":{}".format(port)
+        for l in out.splitlines()[1:]:
+            cols = l.split()
+            if len(cols) >= 4 and cols[3].endswith(suffix):
+                return True
+        return False
+
+    def ldms_dir(self, host = None, port = None, xprt = None, auth = None,
+                 auth_args = None):
+        """Returns the list of set names at `host` (`ldms_ls` dir-only)
+
+        `host` defaults to this container. `port`, `xprt` and `auth` default to
+        the listening endpoint of the ldmsd on `host` according to the spec.
+        `auth_args` is a list of "NAME=VALUE" authentication options.
+
+        Returns `None` if `ldms_ls` failed.
+        """
+        host = host if host else self.hostname
+        cont = self.svc.get_container(host)
+        _xprt, _port, _auth = cont.ldmsd_listen if cont else (None, None, None)
+        xprt = xprt if xprt else (_xprt or "sock")
+        port = port if port else _port
+        auth = auth if auth else (_auth or "none")
+        cmd = "ldms_ls -x {} -p {} -h {} -a {}".format(xprt, port, host, auth)
+        for a in (auth_args or []):
+            cmd += " -A " + a
+        rc, out = self.exec_run(cmd, stderr = False)
+        if rc:
+            return None
+        return out.splitlines()
+
+    def has_sets(self, sets, host = None, **kwargs):
+        """Predicate: all `sets` are present at `host` (see `ldms_dir()`)"""
+        names = self.ldms_dir(host, **kwargs)
+        return names is not None and set(sets) <= set(names)
+
+    def munged_ready(self, dom = None):
+        """Predicate: the munged socket of domain `dom` is present"""
+        m = self.get_munged(dom) or Munged(self, dom)
+        rc, out = self.exec_run("test -S {}".format(m.sock_file))
+        return rc == 0
+
     def start_ldmsd(self, spec_override = {}, **kwargs):
         """Start ldmsd in the container"""
         if self.check_ldmsd():
@@ -1406,8 +1795,33 @@ class LDMSDContainer(DockerClusterContainer):
 
     def kill_ldmsd(self):
         """Kill ldmsd in the container"""
+        ctrl = self.svc.controllers.pop(self.hostname, None)
+        if ctrl:
+            ctrl.close()
         self.exec_run("pkill ldmsd")
 
+    def subst(self, text):
+        """Substitute %VAR% in `text` in the scope of the ldmsd spec
+
+        The variables are the primitive attributes of the cluster spec, the
+        node spec and the ldmsd daemon spec (the innermost wins), the same
+        as the %VAR% substitution in Spec, e.g. "%hostname%".
+        """
+        var = Spec.scope_vars(self.svc.spec, self.spec, self.ldmsd_spec)
+        return Spec.subst_vars(text, var)
+
+    def controller(self):
+        """The persistent `ldmsd_controller` session (see LDMSDController)
+
+        The session is cached in the cluster object, and is closed by
+        `kill_ldmsd()` or by removing the cluster.
+        """
+        ctrls = self.svc.controllers
+        ctrl = ctrls.get(self.hostname)
+        if not ctrl:
+            ctrl = ctrls.setdefault(self.hostname, LDMSDController(self))
+        return ctrl
+
     @cached_property
     def spec(self):
         """Get container spec"""
@@ -1656,10 +2070,53 @@ class LDMSDContainer(DockerClusterContainer):
                 raise RuntimeError("Unsupported daemon type:{}".format(tp))
             fn(**daemon)
 
+    def _sshd_ready(self, daemon):
+        rc, out = self.pgrep("-x sshd")
+        return rc == 0
+
+    def _munged_ready(self, daemon):
+        return self.munged_ready(daemon.get("dom"))
+
+    def _slurmctld_ready(self, daemon):
+        rc, out = self.exec_run("scontrol ping")
+        return rc == 0 and " UP" in out
+
+    def _slurmd_ready(self, daemon):
+        # responding to slurmctld (no '*' suffix on the node state)
+        rc, out = self.exec_run("sinfo -h -N -n {} -o %T" \
+                                .format(self.hostname))
+        out = out.strip()
+        return rc == 0 and bool(out) and not out.endswith("*")
+
+    def _ldmsd_ready(self, daemon):
+        xprt, port, auth = self._ldmsd_listen(daemon)
+        if not port:
+            return self.check_ldmsd()
+        return self.ldmsd_listening(port)
+
+    def daemon_ready(self, daemon):
+        """Predicate: the `daemon` (an entry of spec "daemons") is ready
+
+        - sshd: the process is running,
+        - munged: the socket is present,
+        - slurmctld: `scontrol ping` reports UP,
+        - slurmd: the node is responding to slurmctld,
+        - ldmsd: listening on its (first) port, or running if it does not
+          listen.
+        """
+        tbl = {
+            "sshd": self._sshd_ready,
+            "munged": self._munged_ready,
+            "slurmctld": self._slurmctld_ready,
+            "slurmd": self._slurmd_ready,
+            "ldmsd": self._ldmsd_ready,
+        }
+        fn = tbl.get(daemon["type"])
+        return fn(daemon) if fn else True
+
     def config_ldmsd(self, cmds):
         if not self.pgrepc('ldmsd'):
             raise RuntimeError("There is no running ldmsd to configure")
-        spec = self.ldmsd_spec
         if type(cmds) not in (list, tuple):
             cmds = [ cmds ]
         sio = StringIO()
@@ -1667,15 +2124,7 @@ class LDMSDContainer(DockerClusterContainer):
         for _cmd in cmds:
             sio.write(_cmd)
             sio.write('\n')
-        _listen = spec.get("listen")
-        if _listen:
-            _xprt = _listen[0].get("xprt", "sock")
-            _port = _listen[0].get("port", 10000)
-            _auth = _listen[0].get("auth", "none")
-        else:
-            _xprt = spec["listen_xprt"]
-            _port = spec["listen_port"]
-            _auth = spec["listen_auth"]
+        _xprt, _port, _auth = self.ldmsd_listen
         cmd = 'bash -c \'ldmsd_controller --host {host} ' \
               '--xprt {xprt} ' \
               '--port {port} ' \
@@ -1748,6 +2197,9 @@ class LDMSDCluster(BaseCluster):
             destination path in the CONTAINER, and MODE being `rw` or `ro`.
           - "nodes" is a list of nodes, each item of which describes a node in
             the cluster.
+          - "base_snapshot" (optional) is the name (tag) of the post-setup
+            snapshot image, or a dictionary { "tag": TAG, "sources": [ PATH,
+            ... ], "setup": [ CMD, ... ] }. See `checkpoint()`.
         Templates and "%ATTR%" substitution can be used to reduce repititive
         descriptions in the spec. The "!extends" object attribute is reserved
         for instructing the spec mechanism to apply a template referred to by
@@ -1971,10 +2423,34 @@ class LDMSDCluster(BaseCluster):
                 ],
             }
         """
-        kwargs = cls.spec_to_kwargs(Spec(spec))
+        spec = Spec(spec)
+        kwargs = cls.spec_to_kwargs(spec)
+        snap = cls.snapshot_spec(spec) if spec.get("base_snapshot") else None
+        restored = False
+        if snap:
+            key = cls.snapshot_key(spec)
+            image = cls.find_snapshot(snap["tag"], key)
+            if image:
+                kwargs["image"] = image
+                restored = True
         wrap = super(LDMSDCluster, cls).create(**kwargs)
         lc = LDMSDCluster(wrap.obj)
-        lc.make_ovis_env()
+        lc.make_ovis_env(static = not restored)
+        if snap and not restored:
+            # Every container of this run needs the setup result (not only
+            # the ones committed), so run the setup on all of them at once.
+            def _setup(cont):
+                for cmd in snap["setup"]:
+                    rc, out = cont.exec_run(cmd)
+                    if rc:
+                        raise RuntimeError("snapshot setup `{}` failed on {}, "
+                                           "rc: {}, output: {}" \
+                                .format(cmd, cont.hostname, rc, out))
+            parallel_map(_setup, lc.containers)
+            # the root ssh key pair is the same in all containers of the
+            # image, so the clusters restored from it need no ssh-keygen
+            lc.make_ssh_id()
+            lc.checkpoint(snap["tag"], key)
         return lc
 
     @classmethod
@@ -2054,10 +2530,134 @@ class LDMSDCluster(BaseCluster):
                  )
         return kwargs
 
+    SNAPSHOT_REPO = "ldms-test-snapshot"
+    SNAPSHOT_KEY_LABEL = "LDMSDCluster.snapshot_key"
+
+    @classmethod
+    def snapshot_spec(cls, spec):
+        """Normalized `spec["base_snapshot"]` with the default values"""
+        snap = spec.get("base_snapshot") or {}
+        if type(snap) == str:
+            snap = { "tag": snap }
+        snap = deep_copy(snap)
+        # tada sources (libtada, test programs) by default
+        _dir = os.path.dirname(os.path.realpath(__file__))
+        snap.setdefault("sources", [ _dir + "/C" ])
+        snap.setdefault("setup", [])
+        return snap
+
+    @classmethod
+    def snapshot_key(cls, spec):
+        """The key (sha256 hex digest) identifying the snapshot of `spec`
+
+        The key covers the base image (name and ID), the commit ID of the OVIS
+        installation, the content of the snapshot `sources` and the `setup`
+        commands. A change in any of them invalidates the existing snapshot.
+        """
+        snap = cls.snapshot_spec(spec)
+        image = spec.get("image", "ovis-centos-build")
+        h = hashlib.sha256()
+        h.update(image.encode())
+        try:
+            h.update(docker.from_env().images.get(image).id.encode())
+        except docker.errors.ImageNotFound:
+            pass
+        h.update(get_ovis_commit_id(spec.get("ovis_prefix", "")).encode())
+        for src in sorted(snap["sources"]):
+            paths = [ src ] if os.path.isfile(src) else \
+                    sorted( os.path.join(d, f) for d, _, files in os.walk(src) \
+                                               for f in files )
+            for path in paths:
+                h.update(os.path.relpath(path, src).encode())
+                with open(path, "rb") as f:
+                    h.update(f.read())
+        for cmd in snap["setup"]:
+            h.update(cmd.encode())
+        return h.hexdigest()
+
+    @classmethod
+    def find_snapshot(cls, tag, key):
+        """Returns the snapshot image name if it is usable, otherwise `None`
+
+        The snapshot is usable if the image exists in all docker hosts and its
+        key label matches `key`.
+        """
+        image = "{}:{}".format(cls.SNAPSHOT_REPO, tag)
+        for cl in get_docker_clients():
+            try:
+                img = cl.images.get(image)
+            except docker.errors.ImageNotFound:
+                return None
+            labels = img.attrs["Config"].get("Labels") or {}
+            if labels.get(cls.SNAPSHOT_KEY_LABEL) != key:
+                return None
+        return image
+
+    def checkpoint(self, tag, key = None):
+        """Commit the post-setup container state into a reusable image
+
+        One container on each docker host is committed to
+        "ldms-test-snapshot:`tag`" image labeled with the snapshot `key`
+        (default: `snapshot_key(self.spec)`). The docker hosts that have no
+        container in this cluster receive the image from another host (docker
+        save/load). The clusters created later with the matching
+        "base_snapshot" spec start from this image and skip the setup steps.
+        Note that the mounted paths (e.g. `/data`) are not part of the image.
+
+        Returns the image name.
+        """
+        if key is None:
+            key = self.snapshot_key(self.spec)
+        image = "{}:{}".format(self.SNAPSHOT_REPO, tag)
+        change = "LABEL {}={}".format(self.SNAPSHOT_KEY_LABEL, key)
+        committed = dict() # docker host name -> client
+        for cont in self.containers:
+            cl_name = cont.client.info()["Name"]
+            if cl_name in committed:
+                continue
+            cont.obj.commit(repository = self.SNAPSHOT_REPO, tag = tag,
+                            message = "{} post-setup".format(self.net.name),
+                            changes = [ change ])
+            committed[cl_name] = cont.client
+        src = next(iter(committed.values()))
+        data = None
+        for cl in get_docker_clients():
+            if cl.info()["Name"] in committed:
+                continue
+            if data is None:
+                data = b"".join(src.images.get(image).save())
+            cl.images.load(data)
+        return image
+
     @cached_property
     def spec(self):
         return json.loads(self.labels["LDMSDCluster.spec"])
 
+    _controllers_lock = threading.Lock()
+
+    @property
+    def controllers(self):
+        """The cached `ldmsd_controller` sessions { HOSTNAME : LDMSDController }
+
+        The cache is created under a lock as it is often first used from
+        the worker threads of `config_ldmsd()`.
+        """
+        with self._controllers_lock:
+            ctrls = self.__dict__.get("_controllers")
+            if ctrls is None:
+                ctrls = self._controllers = dict()
+            return ctrls
+
+    def close_controllers(self):
+        """Close all `ldmsd_controller` sessions (see LDMSDController)"""
+        for ctrl in self.controllers.values():
+            ctrl.close()
+        self.controllers.clear()
+
+    def remove(self, *args, **kwargs):
+        self.close_controllers()
+        return super(LDMSDCluster, self).remove(*args, **kwargs)
+
     @property
     def containers(self):
         s = super(LDMSDCluster, self)
@@ -2076,8 +2676,370 @@ class LDMSDCluster(BaseCluster):
 
     def check_ldmsd(self):
         """Returns a dict(hostname:bool) indicating if each ldmsd is running"""
-        return { cont.hostname : cont.check_ldmsd() \
-                                        for cont in self.containers }
+        return { h: rc == 0 \
+                 for h, rc, out in self.fan_out_exec("pgrep -c ldmsd") }
+
+    def wait_ldmsd(self, hosts = None, timeout = 30):
+        """Wait until ldmsd's on `hosts` (default: all ldmsd nodes) listen
+
+        Returns the elapsed time, or `None` on timeout.
+        """
+        if hosts is None:
+            conts = [ c for c in self.containers if c.ldmsd_spec ]
+        else:
+            conts = [ self.get_container(h) for h in hosts ]
+        def ldmsd_listening():
+            ready = parallel_map(lambda c: c.ldmsd_listening(), conts)
+            conts[:] = [ c for c, r in zip(conts, ready) if not r ]
+            return not conts
+        return wait_until(ldmsd_listening, timeout = timeout)
+
+    # the predicates of `wait_sets()` modes: (set names, expected set names)
+    WAIT_SETS_MODES = {
+        "equal"    : lambda names, expected: names == expected,
+        "superset" : lambda names, expected: names >= expected,
+        "absent"   : lambda names, expected: not (names & expected),
+    }
+
+    def ldmsd_poll_interval(self):
+        """The shortest prdcr/updtr interval (seconds) of all ldmsd's in spec
+
+        Returns 1.0 if there is no prdcr or updtr in the spec.
+        """
+        ivals = []
+        for cont in self.containers:
+            dspec = cont.ldmsd_spec
+            for prdcr in dspec.get("prdcrs", []):
+                ivals.append(prdcr.get("interval"))
+            for cfg in dspec.get("config", []):
+                m = re.match(r'\s*updtr_add\s.*\binterval=(\d+)', cfg)
+                if m:
+                    ivals.append(m.group(1))
+        usecs = []
+        for v in ivals:
+            try:
+                usecs.append(int(v))
+            except (TypeError, ValueError):
+                pass # e.g. unsubstituted %VAR%
+        return min(usecs) / 1000000.0 if usecs else 1.0
+
+    def wait_sets(self, host, expected, mode = "equal", timeout = 30,
+                  t0 = None, via = None):
+        """Wait until the set directory of the ldmsd on `host` meets `expected`
+
+        The set directory is polled with `ldms_ls` (dir only) from the `via`
+        container (default: the last container). The polling interval starts
+        at 1/10 of `ldmsd_poll_interval()` and backs off up to the full
+        interval, so that the propagation latency is measured at a resolution
+        that matches the aggregation cadence.
+
+        Parameters
+        ----------
+        host : str
+            The hostname of the ldmsd to poll.
+        expected : list of str
+            The set names.
+        mode : str
+            "equal" - the set names at `host` are exactly `expected`,
+            "superset" - all of `expected` are present at `host`, or
+            "absent" - none of `expected` is present at `host`.
+        timeout : float
+            The timeout (seconds).
+        t0 : float
+            The reference time (`time.time()`) of the latency measurement,
+            e.g. the time the ldmsd was killed (default: now).
+        via : str
+            The name of the container running `ldms_ls`.
+
+        Returns
+        -------
+        float
+            The latency (seconds) from `t0` until the condition is met.
+        None
+            If `timeout` expired.
+        """
+        cond = self.WAIT_SETS_MODES.get(mode)
+        if not cond:
+            raise RuntimeError("Unknown wait_sets mode: {}".format(mode))
+        t0 = time.time() if t0 is None else t0
+        cont = self.get_container(via) if via else self.containers[-1]
+        expected = set(expected)
+        last = [ None, None ] # [ last set names, time the cond is met ]
+        def sets_ready():
+            names = cont.ldms_dir(host)
+            if names is None:
+                return False
+            last[0] = set( n for n in names if n )
+            if not cond(last[0], expected):
+                return False
+            last[1] = time.time()
+            return True
+        ival = self.ldmsd_poll_interval()
+        dt = wait_until(sets_ready, timeout = timeout, interval = ival / 10,
+                        max_interval = ival,
+                        desc = "sets {} at {}".format(mode, host))
+        if dt is None:
+            log.warning("wait_sets {}: expected({}) {}, last dir: {}" \
+                        .format(host, sorted(expected), mode, last[0]))
+            return None
+        return last[1] - t0
+
+    def config_ldmsd(self, cmds, hosts = None, session = True,
+                     max_workers = None):
+        """Send configuration commands to ldmsd's on `hosts` concurrently
+
+        Parameters
+        ----------
+        cmds : str or list of str
+            The ldmsd configuration commands. %VAR% in the commands is
+            substituted for each host (see `LDMSDContainer.subst()`), e.g.
+            "prdcr_add name=%hostname%-prdcr ...".
+        hosts : str or list of str
+            A regular expression matching the hostnames, or a list of
+            hostnames (default: all nodes having ldmsd).
+        session : bool
+            Use the persistent `ldmsd_controller` sessions (see
+            `LDMSDContainer.controller()`), or spawn a new `ldmsd_controller`
+            for each host (`LDMSDContainer.config_ldmsd()`).
+        max_workers : int
+            The maximum number of hosts configured concurrently.
+
+        Returns
+        -------
+        dict
+            { HOSTNAME : (rc, output) }. If configuring a host raised an
+            exception, its rc is -1 and the output is the error message.
+        """
+        if type(cmds) not in (list, tuple):
+            cmds = [ cmds ]
+        if hosts is None or type(hosts) == str:
+            conts = [ c for c in self.containers if c.ldmsd_spec and \
+                        (hosts is None or re.fullmatch(hosts, c.hostname)) ]
+        else:
+            conts = [ self.get_container(h) for h in hosts ]
+            missing = [ h for h, c in zip(hosts, conts) if c is None ]
+            if missing:
+                raise RuntimeError("Containers not found: {}".format(missing))
+        # substitute before going concurrent so that errors raise here
+        host_cmds = [ (c, [ c.subst(x) for x in cmds ]) for c in conts ]
+        def _config(ent):
+            cont, _cmds = ent
+            try:
+                if session:
+                    return cont.controller().config_ldmsd(_cmds)
+                return cont.config_ldmsd(_cmds)
+            except Exception as e:
+                log.warning("{}: config_ldmsd error: {}" \
+                            .format(cont.hostname, e))
+                return (-1, str(e))
+        results = parallel_map(_config, host_cmds, max_workers = max_workers)
+        return { c.hostname: r for c, r in zip(conts, results) }
+
+    # the base states (without flags) of the nodes that need `resume`
+    SLURM_RESUME_STATES = set(["drained", "draining", "drain", "down"])
+    # the terminal job states
+    SLURM_JOB_DONE_STATES = set(["COMPLETED", "FAILED", "CANCELLED", "TIMEOUT",
+                                 "NODE_FAIL", "PREEMPTED", "BOOT_FAIL",
+                                 "DEADLINE", "OUT_OF_MEMORY"])
+
+    def slurm_node_states(self):
+        """{ NODE : STATE } from a single `sinfo` query
+
+        The STATE is as reported by `sinfo %T`, e.g. "idle", "drained",
+        "down*" (the '*' suffix means not responding).
+        """
+        rc, out = self.exec_run("sinfo -h -N -o '%N %T'")
+        if rc:
+            raise RuntimeError("sinfo error, rc: {}, output: {}" \
+                               .format(rc, out))
+        return dict( l.split() for l in out.splitlines() if l.strip() )
+
+    def wait_slurm_ready(self, nodes = None, timeout = 60, resume = True,
+                         states = ("idle",)):
+        """Wait until all slurmd `nodes` (default: all) are in `states`
+
+        The node states are polled with a single `sinfo` per poll with
+        adaptive (backoff) interval. If `resume` is True, the responding
+        nodes that are down or drained (e.g. slurmd registered late) are
+        resumed with a single `scontrol update` per poll.
+
+        Returns the elapsed time (seconds), or `None` on timeout.
+        """
+        resumed = set()
+        def slurm_ready():
+            st = self.slurm_node_states()
+            _nodes = nodes if nodes is not None else list(st)
+            if not _nodes:
+                return False
+            to_resume = []
+            ready = True
+            for n in _nodes:
+                s = st.get(n, "unknown*")
+                base = s.rstrip("*").split("+")[0]
+                if base not in states:
+                    ready = False
+                if resume and not s.endswith("*") and \
+                        base in self.SLURM_RESUME_STATES:
+                    to_resume.append(n)
+            if to_resume:
+                if set(to_resume) - resumed:
+                    log.info("resuming slurm nodes: {}".format(to_resume))
+                resumed.update(to_resume)
+                self.exec_run("scontrol update nodename={} state=resume" \
+                              .format(",".join(to_resume)))
+            return ready
+        return wait_until(slurm_ready, timeout = timeout, interval = 0.2,
+                          max_interval = 2.0, desc = "slurm ready")
+
+    @staticmethod
+    def _slurm_time(txt, tz_sec):
+        """(private) slurm time string -> epoch (`None` if unknown)"""
+        try:
+            t = time.strptime(txt, "%Y-%m-%dT%H:%M:%S")
+        except (TypeError, ValueError):
+            return None # e.g. "Unknown", "None"
+        return calendar.timegm(t) - tz_sec
+
+    def slurm_jobs(self):
+        """{ JOBID : { "state", "submit", "start", "end", ... } }
+
+        All jobs known to slurmctld from a single `scontrol -o show job`
+        query. "submit", "start" and "end" are epoch timestamps (`None` if not
+        yet known), converted using the time zone of the service container.
+        "job" contains all attributes reported by `scontrol`.
+        """
+        rc, out = self.exec_run(["/bin/bash", "-c",
+                                 "date +%z; scontrol -o show job"])
+        if rc:
+            raise RuntimeError("scontrol error, rc: {}, output: {}" \
+                               .format(rc, out))
+        lines = out.splitlines()
+        tz = lines.pop(0).strip() # e.g. "+0000"
+        tz_sec = (1 if tz[0] == "+" else -1) * \
+                 (int(tz[1:3]) * 3600 + int(tz[3:5]) * 60)
+        jobs = dict()
+        for l in lines:
+            job = dict(re.findall(r'(\S+?)=(\S*)', l))
+            if "JobId" not in job:
+                continue # e.g. "No jobs in the system"
+            jobs[int(job["JobId"])] = {
+                "state": job.get("JobState"),
+                "submit": self._slurm_time(job.get("SubmitTime"), tz_sec),
+                "start": self._slurm_time(job.get("StartTime"), tz_sec),
+                "end": self._slurm_time(job.get("EndTime"), tz_sec),
+                "job": job,
+            }
+        return jobs
+
+    def wait_jobs(self, jobids, states = None, timeout = 60):
+        """Wait until all `jobids` reach one of `states`
+
+        Parameters
+        ----------
+        jobids : list of int
+            The job IDs (a single job ID is also accepted).
+        states : list of str
+            The job states to wait for (default: the terminal states, e.g.
+            "COMPLETED", "FAILED", "CANCELLED", "TIMEOUT").
+        timeout : float
+            The timeout (seconds).
+
+        The jobs are polled with a single `scontrol` query per poll (see
+        `slurm_jobs()`) with adaptive (backoff) interval.
+
+        Returns
+        -------
+        dict
+            { JOBID : { "state", "submit", "start", "end", "job" } } of the
+            last poll (see `slurm_jobs()`). A job that is not known to
+            slurmctld has `None` state. On timeout, a warning is logged and
+            the states of some jobs are not in `states`.
+        """
+        if type(jobids) not in (list, tuple, set):
+            jobids = [ jobids ]
+        states = set(states) if states else self.SLURM_JOB_DONE_STATES
+        result = dict()
+        def jobs_done():
+            jobs = self.slurm_jobs()
+            for j in jobids:
+                result[j] = jobs.get(j, dict(state = None, submit = None,
+                                             start = None, end = None,
+                                             job = None))
+            return all( result[j]["state"] in states for j in jobids )
+        dt = wait_until(jobs_done, timeout = timeout, interval = 0.2,
+                        max_interval = 2.0,
+                        desc = "jobs {} {}".format(list(jobids),
+                                                   "|".join(sorted(states))))
+        if dt is None:
+            log.warning("wait_jobs timeout, job states: {}".format(
+                        { j: r["state"] for j, r in result.items() }))
+        return result
+
+    def ldmsd_tiers(self):
+        """{ HOSTNAME : TIER } of the aggregation hierarchy in the spec
+
+        TIER is "sampler" for an ldmsd without producers, "L1" for an
+        aggregator of samplers, "L2" for an aggregator of "L1", and so on, or
+        `None` for a node without ldmsd.
+        """
+        prdcrs = dict()
+        for c in self.containers:
+            if c.ldmsd_spec:
+                prdcrs[c.hostname] = [ p.get("host") for p in \
+                                       c.ldmsd_spec.get("prdcrs", []) ]
+        alias = dict()
+        for h, names in self.node_aliases.items():
+            for a in names:
+                alias[a] = h
+        levels = dict()
+        def _level(h, depth = 0):
+            if h not in levels:
+                if depth > len(prdcrs):
+                    raise RuntimeError("Cyclic producers at {}".format(h))
+                hs = [ alias.get(p, p) for p in prdcrs.get(h, []) ]
+                hs = [ p for p in hs if p in prdcrs ]
+                levels[h] = 1 + max( _level(p, depth + 1) for p in hs ) \
+                            if hs else 0
+            return levels[h]
+        tiers = dict()
+        for c in self.containers:
+            if c.hostname not in prdcrs:
+                tiers[c.hostname] = None
+                continue
+            lvl = _level(c.hostname)
+            tiers[c.hostname] = "L{}".format(lvl) if lvl else "sampler"
+        return tiers
+
+    def start_resource_sampler(self, path, interval = 1.0, procs = None):
+        """Start a ResourceSampler thread writing samples to `path` (JSONL)
+
+        `procs` is the list of process names to probe in `/proc`
+        (default: `ResourceSampler.PROCS`). Call `stop()` of the returned
+        sampler to stop it and get the per-tier summary.
+        """
+        sampler = ResourceSampler(self, path, interval = interval,
+                                  procs = procs or ResourceSampler.PROCS)
+        sampler.start()
+        return sampler
+
+    def slurmd_registered(self, nodes = None):
+        """Predicate: slurmd on `nodes` (default: all) registered to slurmctld
+
+        A node is registered if `sinfo` reports it responding (no '*' suffix)
+        in a state other than "unknown" or "down".
+        """
+        rc, out = self.exec_run("sinfo -h -N -o '%N %T'")
+        if rc:
+            return False
+        states = dict( l.split() for l in out.splitlines() if l.strip() )
+        if nodes is None:
+            nodes = states.keys()
+        for node in nodes:
+            st = states.get(node)
+            if not st or st.endswith("*") or \
+                    st.split("+")[0] in ("unknown", "down"):
+                return False
+        return True
 
     @cached_property
     def slurm_version(self):
@@ -2154,16 +3116,40 @@ class LDMSDCluster(BaseCluster):
                     slurm_loglevel = slurm_loglevel )
         return slurmconf
 
-    def start_munged(self, **kwargs):
-        """Start Munge Daemon"""
-        for cont in self.containers:
-            cont.start_munged(**kwargs)
+    def start_munged(self, doms = None, max_workers = None, **kwargs):
+        """Start Munge Daemon in all containers concurrently
 
-    def start_slurm(self):
-        """Start slurmd in all sampler nodes, and slurmctld on svc node"""
+        If `doms` is not given, `cont.start_munged(**kwargs)` is called for
+        each container. Otherwise, `doms` is a list of domain names, or of
+        dict(dom = DOM, key = KEY), and all of the domains (with their keys)
+        are started in each container with a single exec (see
+        `Munged.start_all()`). `dom = None` is the default domain.
+        """
+        if doms is None:
+            parallel_map(lambda c: c.start_munged(**kwargs), self.containers,
+                         max_workers = max_workers)
+            return
+        doms = [ d if type(d) == dict else dict(dom = d) for d in doms ]
+        def _start(cont):
+            mlist = []
+            for d in doms:
+                m = Munged(cont, d.get("dom"), d.get("key"))
+                cont.set_munged(d.get("dom"), m)
+                mlist.append(m)
+            Munged.start_all(cont, mlist)
+        parallel_map(_start, self.containers, max_workers = max_workers)
+
+    def start_slurm(self, wait = True):
+        """Start slurmd in all sampler nodes, and slurmctld on svc node
+
+        If `wait` is True, also wait until all slurmd nodes are ready (see
+        `wait_slurm_ready()`).
+        """
         self.start_munged()
         for cont in self.containers:
             cont.start_slurm()
+        if wait:
+            self.wait_slurm_ready()
 
     def start_sshd(self):
         """Start sshd in all containers"""
@@ -2181,27 +3167,91 @@ class LDMSDCluster(BaseCluster):
         rc, out = cont.exec_run(cmd, stderr=False)
         return out
 
-    def make_known_hosts(self):
-        """Make `/root/.ssh/known_hosts` in all nodes"""
-        ks = self.ssh_keyscan()
-        for cont in self.containers:
-            cont.exec_run("mkdir -p /root/.ssh")
-            cont.write_file("/root/.ssh/known_hosts", ks)
+    @cached_property
+    def ssh_host_keys(self):
+        """The ["TYPE KEY", ...] sshd host public keys
 
-    def make_ssh_id(self):
-        """Make `/root/.ssh/id_rsa` and authorized_keys"""
+        The host keys are baked into the image (see docker/Dockerfile), hence
+        they are the same in all containers and are read only once.
+        """
+        rc, out = self.exec_run(["/bin/bash", "-c",
+                                 "cat /etc/ssh/ssh_host_*_key.pub"])
+        if rc:
+            raise RuntimeError("Cannot read ssh host keys, rc: {}, out: {}" \
+                               .format(rc, out))
+        return [ " ".join(l.split()[:2]) for l in out.splitlines() \
+                                          if l.strip() ]
+
+    def known_hosts(self):
+        """The known_hosts content derived from the host keys and the nodes
+
+        Each node (hostname, IP address and aliases) gets a line for each of
+        `ssh_host_keys`. No network scanning is involved.
+        """
+        lines = []
+        for c in self.containers:
+            names = ",".join( n for n in [c.hostname, c.ip_addr] + c.aliases \
+                                if n )
+            lines.extend( "{} {}".format(names, k) for k in self.ssh_host_keys )
+        return "\n".join(lines) + "\n"
+
+    def _put_ssh_files(self, files):
+        """(private) Write `files` to all containers, one transfer each"""
+        parallel_map(lambda c: c.write_files(files), self.containers)
+
+    def make_known_hosts(self, scan = False):
+        """Make `/root/.ssh/known_hosts` in all nodes
+
+        By default, the known_hosts is derived from the host keys of the image
+        and the node table (see `known_hosts()`). If `scan` is True, it is
+        obtained by `ssh-keyscan` (see `ssh_keyscan()`) instead.
+        """
+        ks = self.ssh_keyscan() if scan else self.known_hosts()
+        self._put_ssh_files({ "/root/.ssh/known_hosts": ks })
+
+    @cached_property
+    def from_snapshot(self):
+        """`True` if the containers are created from a base snapshot image"""
+        image = self.containers[-1].attrs["Config"]["Image"]
+        return image.startswith(self.SNAPSHOT_REPO + ":")
+
+    def make_ssh_id(self, known_hosts = False, force = False):
+        """Make `/root/.ssh/id_rsa` and authorized_keys
+
+        The key pair is generated in the last container, and is distributed
+        to all containers in a single transfer per container (together with
+        the known_hosts if `known_hosts` is True). The containers created from
+        a base snapshot already share the key pair of the snapshot image, in
+        which case only the known_hosts is written (unless `force` is True).
+        """
         cont = self.containers[-1]
-        cont.exec_run("mkdir -p /root/.ssh/")
-        cont.exec_run("rm -f id_rsa id_rsa.pub", workdir="/root/.ssh/")
-        cont.exec_run("ssh-keygen -q -N '' -f /root/.ssh/id_rsa")
-        D.id_rsa = id_rsa = cont.read_file("/root/.ssh/id_rsa")
-        D.id_rsa_pub = id_rsa_pub = cont.read_file("/root/.ssh/id_rsa.pub")
-        for cont in self.containers:
-            cont.exec_run("mkdir -p /root/.ssh/")
-            cont.write_file("/root/.ssh/id_rsa", id_rsa)
-            cont.exec_run("chmod 600 /root/.ssh/id_rsa")
-            cont.write_file("/root/.ssh/id_rsa.pub", id_rsa_pub)
-            cont.write_file("/root/.ssh/authorized_keys", id_rsa_pub)
+        if self.from_snapshot and not force:
+            rc, out = cont.exec_run(["/bin/bash", "-c",
+                        "cd /root/.ssh && test -s id_rsa && "
+                        "grep -qF \"$(cat id_rsa.pub)\" authorized_keys"])
+            if rc == 0:
+                if known_hosts:
+                    self.make_known_hosts()
+                return
+        rc, out = cont.exec_run(["/bin/bash", "-c",
+                    "mkdir -p /root/.ssh && cd /root/.ssh && "
+                    "rm -f id_rsa id_rsa.pub && "
+                    "ssh-keygen -q -N '' -f /root/.ssh/id_rsa && "
+                    "cat id_rsa id_rsa.pub"])
+        if rc:
+            raise RuntimeError("ssh-keygen error, rc: {}, out: {}" \
+                               .format(rc, out))
+        lines = out.splitlines(True)
+        D.id_rsa = id_rsa = "".join(lines[:-1])
+        D.id_rsa_pub = id_rsa_pub = lines[-1]
+        files = {
+            "/root/.ssh/id_rsa": (id_rsa, 0o600),
+            "/root/.ssh/id_rsa.pub": id_rsa_pub,
+            "/root/.ssh/authorized_keys": id_rsa_pub,
+        }
+        if known_hosts:
+            files["/root/.ssh/known_hosts"] = self.known_hosts()
+        self._put_ssh_files(files)
 
     def exec_run(self, *args, **kwargs):
         """A pass-through to last_cont.exec_run()
@@ -2244,6 +3294,104 @@ class LDMSDCluster(BaseCluster):
         job_id = int(m.group(1))
         return job_id
 
+    def sbatch_many(self, scripts, array = None, rate = None,
+                    workdir = "/db", prefix = "sbatch_many"):
+        """Submit many slurm batch jobs with a single transfer and exec
+
+        All job scripts (and the submission loop) are written to the service
+        node (the last container) in a single transfer (`write_files()`),
+        then submitted by a single in-container loop.
+
+        Parameters
+        ----------
+        scripts : list(str), dict, or str
+            The contents of the job scripts, which are written to
+            "`workdir`/`prefix`.N.sh", or { PATH : CONTENT }. A single script
+            (`str`) is submitted once, or as a job array if `array` is given.
+        array : str
+            The `sbatch --array` specification, e.g. "0-99" or "0-99%10".
+            `scripts` must be a single script.
+        rate : float
+            The submission rate (jobs/sec). By default, the jobs are
+            submitted back-to-back.
+        workdir : str
+            The directory of the generated scripts; also the working directory
+            of `sbatch`.
+        prefix : str
+            The prefix of the generated script file names. The stderr of the
+            successful submissions is logged in "`workdir`/`prefix`.submit.log".
+
+        Returns
+        -------
+        [ (jobid, submit_time), ... ]
+            The job IDs (`int`) in the submission order and the time
+            (`time.time()` in the container) right after each submission. For
+            a job array, the single job ID is the array job ID (its tasks are
+            "JOBID_TASKID").
+
+        Raises
+        ------
+        RuntimeError
+            If any of the submissions failed.
+        """
+        if type(scripts) == str:
+            scripts = [ scripts ]
+        if array is not None and len(scripts) != 1:
+            raise RuntimeError("`array` requires a single script")
+        if type(scripts) == dict:
+            files = { p: (c, 0o755) for p, c in scripts.items() }
+        else:
+            files = { "{}/{}.{}.sh".format(workdir, prefix, i): (c, 0o755) \
+                      for i, c in enumerate(scripts) }
+        paths = list(files)
+        opt = "--array={}".format(array) if array is not None else ""
+        pace = "" # rate control: sleep until t0 + i/rate
+        if rate:
+            pace = 'd=$(awk "BEGIN{{d=$t0+$i/{}-$(date +%s.%N); ' \
+                   'print (d>0)?d:0}}"); sleep $d'.format(float(rate))
+        # the job ID is the last line of the stdout of `sbatch --parsable`;
+        # the stderr (e.g. "sbatch: warning: ...") of a successful submission
+        # goes to the log, and to the ERR line of a failed one.
+        loop = "\n".join([
+                "cd {}".format(workdir),
+                "err={}.sbatch.err; log={}.submit.log".format(prefix, prefix),
+                ": > $log",
+                "t0=$(date +%s.%N); i=0",
+                "for f in {}; do".format(" ".join(paths)),
+                "  " + (pace if pace else ":"),
+                "  if out=$(sbatch --parsable {} $f 2>$err); then".format(opt),
+                "    id=$(echo \"$out\" | tail -n 1); id=${id%%;*}",
+                "    cat $err >> $log",
+                "    case \"$id\" in",
+                "    ''|*[!0-9]*) echo ERR $f bad job id: $out $(cat $err) ;;",
+                "    *) echo OK $id $(date +%s.%N) ;;",
+                "    esac",
+                "  else",
+                "    echo ERR $f $out $(cat $err)",
+                "  fi",
+                "  i=$((i+1))",
+                "done",
+                "rm -f $err",
+            ])
+        runner = "{}/{}.submit.sh".format(workdir, prefix)
+        files[runner] = (loop, 0o755)
+        cont = self.containers[-1]
+        cont.write_files(files)
+        rc, out = cont.exec_run(["/bin/bash", runner])
+        jobs = []
+        errs = []
+        for l in out.splitlines():
+            ent = l.split(" ", 2)
+            if ent[0] == "OK":
+                jobs.append( (int(ent[1]), float(ent[2])) )
+            elif ent[0] == "ERR":
+                errs.append(l[4:])
+        if rc or errs:
+            raise RuntimeError("sbatch_many error, rc: {}, submitted: {}, "
+                               "errors: {}".format(rc, [ j for j, t in jobs ],
+                                                   errs))
+        return jobs
+
     def squeue(self, jobid = None):
         """Execute `squeue` and parse the results
 
@@ -2282,17 +3430,35 @@ class LDMSDCluster(BaseCluster):
         cmd = "ldms_ls " + (" ".join(args))
         return self.exec_run(cmd)
 
-    def make_ovis_env(self):
+    def make_ovis_env(self, static = True):
         """Make ovis environment (ld, profile)
 
         NOTE: We need the ld.so.conf.d/ovis.conf because the process
         initializing slurm job forked from slurmd does not inherit
         LD_LIBRARY_PATH. The /etc/profile.d/ovis.sh is for ssh session's
         convenience (making ldms binaries available for SSH session).
+
+        If `static` is `False`, only the cluster-specific part (pssh profile)
+        is made. The containers started from a base snapshot already have the
+        ld.so configuration and the ovis profile.
         """
         allhosts = set([ c.hostname for c in self.containers ])
         allhosts_txt = ' '.join(allhosts)
         for cont in self.containers:
+            otherhosts = allhosts - set([cont.hostname])
+            otherhosts_txt = ' '.join(otherhosts)
+            pssh_profile = """
+                export ALLHOSTS='{allhosts_txt}'
+                export OTHERHOSTS='{otherhosts_txt}'
+                alias pssh.others='pssh -H "${{OTHERHOSTS}}"'
+                alias pscp.others='pscp.pssh -H "${{OTHERHOSTS}}"'
+            """.format(
+                    allhosts_txt = allhosts_txt,
+                    otherhosts_txt = otherhosts_txt,
+                )
+            cont.write_file("/etc/profile.d/pssh.sh", pssh_profile)
+            if not static:
+                continue
             cont.write_file("/etc/ld.so.conf.d/ovis.conf",
                             "/opt/ovis/lib\n"
                             "/opt/ovis/lib64\n"
@@ -2327,31 +3493,335 @@ class LDMSDCluster(BaseCluster):
                 _add LDMSD_PLUGIN_LIBPATH $PREFIX/lib64/ovis-ldms
             """
             cont.write_file("/etc/profile.d/ovis.sh", profile)
-            otherhosts = allhosts - set([cont.hostname])
-            otherhosts_txt = ' '.join(otherhosts)
-            pssh_profile = """
-                export ALLHOSTS='{allhosts_txt}'
-                export OTHERHOSTS='{otherhosts_txt}'
-                alias pssh.others='pssh -H "${{OTHERHOSTS}}"'
-                alias pscp.others='pscp.pssh -H "${{OTHERHOSTS}}"'
-            """.format(
-                    allhosts_txt = allhosts_txt,
-                    otherhosts_txt = otherhosts_txt,
-                )
-            cont.write_file("/etc/profile.d/pssh.sh", pssh_profile)
 
     def pgrepc(self, prog):
         """Perform `cont.pgrepc(prog)` for cont in self.containers"""
-        return { cont.hostname : cont.pgrepc(prog) \
-                                    for cont in self.containers }
+        return { h: int(out) if out.strip().isdigit() else 0 \
+                 for h, rc, out in self.fan_out_exec("pgrep -c " + prog) }
+
+    def start_daemons(self, serial = False, timeout = 60, max_workers = 32):
+        """Start daemons according to spec
+
+        By default, the daemons in all containers are started concurrently in
+        the dependency order (see `daemon_dag()`): a daemon is started when
+        all daemons it depends on are ready (see
+        `LDMSDContainer.daemon_ready()`, waiting up to `timeout` seconds for
+        each daemon). The timing breakdown of the critical path is logged and
+        returned (see `start_daemons_dag()`). `RuntimeError` is raised if any
+        daemon is not ready in time; its dependents are not started.
+
+        If `serial` is True, the daemons are started one container at a time
+        in the order of the spec, and `None` is returned.
+        """
+        if serial:
+            for cont in self.containers:
+                cont.start_daemons()
+            return None
+        return self.start_daemons_dag(timeout = timeout,
+                                      max_workers = max_workers)
+
+    def daemon_dag(self):
+        """The daemon dependency graph derived from the spec
+
+        The daemons are identified by "HOSTNAME/NAME" (NAME is the daemon
+        "name", or its "type" if the name is not given). The dependencies are:
+        - the daemons listed in "requires" (by name, on the same node),
+        - munged (default domain) on the same node -> slurmctld, slurmd,
+        - munged on the same node -> ldmsd using "munge" authentication in
+          "listen_auth", "listen" or "prdcrs", either directly or through a
+          named "auth" domain with "plugin": "munge" (the munged serving the
+          "socket" of the domain, or all munged on the node if none does),
+        - slurmctld -> slurmd,
+        - ldmsd on the "host" of each of its "prdcrs" -> ldmsd (e.g.
+          samplers -> L1 aggregators -> L2 aggregators),
+        - the previous daemon on the same node in the spec order -> daemon
+          (as `LDMSDContainer.start_daemons()` does), unless the node or the
+          cluster spec has "ordered_daemons": False, or the previous daemon
+          depends on the daemon through the other dependencies.
 
-    def start_daemons(self):
-        """Start daemons according to spec"""
-        for cont in self.containers:
-            cont.start_daemons()
+        Returns
+        -------
+        (tasks, deps)
+            `tasks` is { KEY : (LDMSDContainer, DAEMON_SPEC) } and `deps` is
+            { KEY : set(KEY) }.
+        """
+        tasks = dict()
+        keys = dict() # (hostname, name) -> KEY
+        alias = dict() # host name/alias -> hostname
+        conts = self.containers
+        for cont in conts:
+            alias[cont.hostname] = cont.hostname
+            for a in self.node_aliases.get(cont.hostname, []):
+                alias[a] = cont.hostname
+            for d in cont.spec.get("daemons", []):
+                if d["type"] not in cont.DAEMON_TBL:
+                    raise RuntimeError("Unsupported daemon type:{}" \
+                                       .format(d["type"]))
+                name = d.get("name", d["type"])
+                key = "{}/{}".format(cont.hostname, name)
+                if key in tasks:
+                    key += "#{}".format(len(tasks))
+                tasks[key] = (cont, d)
+                keys.setdefault((cont.hostname, name), key)
+        deps = { k: set() for k in tasks }
+        def _of_type(host, tp, cond = lambda d: True):
+            return [ k for k, (c, d) in tasks.items() \
+                       if c.hostname == host and d["type"] == tp and cond(d) ]
+        ctlds = [ k for k, (c, d) in tasks.items() if d["type"] == "slurmctld" ]
+        def _munge_deps(host, d, auth):
+            """munged keys serving `auth` (a plugin or a domain name) of `d`"""
+            doms = { a.get("name"): a for a in d.get("auth", []) \
+                                      if type(a) == dict }
+            dom = doms.get(auth, { "plugin": auth })
+            if dom.get("plugin") != "munge":
+                return []
+            ms = _of_type(host, "munged")
+            sock = dom.get("socket", "/run/munge/munge.socket.2")
+            match = [ k for k in ms if sock == \
+                        ("/munge/{}/sock".format(tasks[k][1]["dom"]) \
+                         if tasks[k][1].get("dom") else \
+                         "/run/munge/munge.socket.2") ]
+            return match or ms
+        for key, (cont, d) in tasks.items():
+            host = cont.hostname
+            for name in d.get("requires", []):
+                dep = keys.get((host, name))
+                if not dep:
+                    raise RuntimeError("{}: required daemon '{}' not found" \
+                                       .format(key, name))
+                deps[key].add(dep)
+            tp = d["type"]
+            if tp in ("slurmctld", "slurmd"):
+                deps[key].update(_of_type(host, "munged",
+                                          lambda m: not m.get("dom")))
+            if tp == "slurmd":
+                deps[key].update(ctlds)
+            if tp == "ldmsd":
+                auths = [ d.get("listen_auth") ] + \
+                        [ l.get("auth") for l in d.get("listen", []) ] + \
+                        [ p.get("auth") for p in d.get("prdcrs", []) ]
+                for auth in set(auths):
+                    deps[key].update(_munge_deps(host, d, auth))
+                for prdcr in d.get("prdcrs", []):
+                    phost = alias.get(prdcr.get("host"))
+                    if phost and phost != host:
+                        deps[key].update(_of_type(phost, "ldmsd"))
+        # keep the spec order of the daemons within a node
+        def _depends(k, on):
+            seen, todo = set(), [ k ]
+            while todo:
+                x = todo.pop()
+                if x == on:
+                    return True
+                if x not in seen:
+                    seen.add(x)
+                    todo.extend(deps[x])
+            return False
+        prev = dict() # hostname -> the previous daemon key
+        for key, (cont, d) in tasks.items():
+            host = cont.hostname
+            ordered = cont.spec.get("ordered_daemons",
+                                    self.spec.get("ordered_daemons", True))
+            p = prev.get(host)
+            if ordered and p and not _depends(p, key):
+                deps[key].add(p)
+            prev[host] = key
+        # cycle check (Kahn)
+        indeg = { k: len(v) for k, v in deps.items() }
+        ready = [ k for k, n in indeg.items() if not n ]
+        while ready:
+            k = ready.pop()
+            for r, v in deps.items():
+                if k in v:
+                    indeg[r] -= 1
+                    if not indeg[r]:
+                        ready.append(r)
+        cyc = [ k for k, n in indeg.items() if n ]
+        if cyc:
+            raise RuntimeError("Cyclic daemon dependency: {}".format(cyc))
+        return tasks, deps
+
+    def start_daemons_dag(self, timeout = 60, max_workers = 32):
+        """Start the daemons concurrently following `daemon_dag()`
+
+        Returns
+        -------
+        dict
+            {
+              "total": SECONDS,
+              "daemons": { KEY : TIMING },
+              "critical_path": [ TIMING, ... ],
+            }
+            where TIMING is { "daemon": KEY, "begin": SEC_SINCE_T0,
+            "start": START_SEC, "ready": READY_WAIT_SEC, "end": SEC_SINCE_T0,
+            "ok": READY_BOOL }.
 
-    def all_exec_run(self, cmd):
-        return { c.hostname: c.exec_run(cmd) for c in self.containers }
+        Raises
+        ------
+        RuntimeError
+            If any daemon is not ready within `timeout` seconds. The daemons
+            depending on it (directly or not) are not started, and the others
+            are started before the error is raised.
+        """
+        t0 = time.time()
+        tasks, deps = self.daemon_dag()
+        rdeps = { k: set() for k in tasks }
+        for k, v in deps.items():
+            for d in v:
+                rdeps[d].add(k)
+        timing = dict()
+        def _start(key):
+            cont, daemon = tasks[key]
+            t1 = time.time()
+            cont.DAEMON_TBL[daemon["type"]](**daemon)
+            t2 = time.time()
+            dt = wait_until(lambda: cont.daemon_ready(daemon),
+                            timeout = timeout, desc = key + " ready")
+            t3 = time.time()
+            timing[key] = dict(daemon = key, begin = t1 - t0, start = t2 - t1,
+                               ready = t3 - t2, end = t3 - t0,
+                               ok = dt is not None)
+        pending = { k: set(v) for k, v in deps.items() }
+        with concurrent.futures.ThreadPoolExecutor(max_workers) as ex:
+            running = dict()
+            def _submit():
+                for k in [ k for k, v in pending.items() if not v ]:
+                    pending.pop(k)
+                    running[ex.submit(_start, k)] = k
+            _submit()
+            while running:
+                done, _ = concurrent.futures.wait(running,
+                            return_when = concurrent.futures.FIRST_COMPLETED)
+                for f in done:
+                    k = running.pop(f)
+                    f.result() # re-raise the start error
+                    if not timing[k]["ok"]:
+                        continue # its dependents stay pending
+                    for r in rdeps[k]:
+                        pending[r].discard(k)
+                _submit()
+        # critical path: from the last ready daemon back through the latest
+        # ready dependency
+        path = []
+        k = max(timing, key = lambda x: timing[x]["end"]) if timing else None
+        while k:
+            path.insert(0, timing[k])
+            k = max(deps[k], key = lambda x: timing[x]["end"]) \
+                    if deps[k] else None
+        total = time.time() - t0
+        log.info("start_daemons: {} daemons in {:.3f} sec, critical path:" \
+                 .format(len(tasks), total))
+        for t in path:
+            log.info("  {daemon}: begin +{begin:.3f}, start {start:.3f} sec, "
+                     "ready {ready:.3f} sec{0}".format(
+                         "" if t["ok"] else " (NOT READY)", **t))
+        failed = sorted( k for k, t in timing.items() if not t["ok"] )
+        if failed:
+            raise RuntimeError("start_daemons: not ready in {} sec: {}, "
+                               "not started: {}".format(timeout, failed,
+                                                        sorted(pending)))
+        return dict(total = total, daemons = timing, critical_path = path)
+
+    # pssh -i output header, e.g. "[1] 12:00:00 [SUCCESS] node-1",
+    # "[2] 12:00:00 [FAILURE] node-2 Exited with error code 1"
+    _PSSH_HDR_RE = re.compile(r'^\[\d+\] \S+ \[(?P<status>SUCCESS|FAILURE)\] '
+                              r'(?P<host>\S+)(?P<msg>.*)$')
+
+    def fan_out_exec(self, cmd, hosts = None, max_workers = 16,
+                     timeout = None, mode = "docker"):
+        """Execute `cmd` on `hosts`, yielding (host, rc, output) as completed
+
+        Parameters
+        ----------
+        cmd : str
+            The command (`exec_run()` semantics in "docker" mode; a remote
+            shell command line in "pssh" mode).
+        hosts : list of str
+            The hostnames (default: all containers).
+        max_workers : int
+            The maximum number of concurrent executions.
+        timeout : float
+            The per-host timeout (seconds). The command is wrapped with
+            coreutils `timeout` in "docker" mode, or uses `pssh -t` in "pssh"
+            mode. A timed-out command has rc 124.
+        mode : str
+            "docker" - the test driver runs `docker exec` on each container
+            concurrently, or
+            "pssh" - a single `pssh` in the last container (the headnode)
+            fans out over ssh inside the cluster, so that the driver is not
+            the bottleneck for large clusters. This requires the ssh identity
+            and known_hosts (see `make_ssh_id()`, `make_known_hosts()`).
+        """
+        if mode == "pssh":
+            yield from self._pssh_exec(cmd, hosts, max_workers, timeout)
+            return
+        if mode != "docker":
+            raise RuntimeError("Unknown fan-out mode: {}".format(mode))
+        conts = self.containers if hosts is None else \
+                [ self.get_container(h) for h in hosts ]
+        args = cmd
+        if timeout:
+            args = [ "timeout", str(timeout) ] + \
+                   (shlex.split(cmd) if type(cmd) == str else list(cmd))
+        for cont, res, exc in fan_out(lambda c: c.exec_run(args), conts,
+                                      max_workers = max_workers):
+            if exc:
+                yield cont.hostname, -1, str(exc)
+            else:
+                yield (cont.hostname,) + tuple(res)
+
+    def _pssh_exec(self, cmd, hosts, max_workers, timeout):
+        """(private) The "pssh" mode of `fan_out_exec()`"""
+        if hosts is None:
+            hosts = [ c.hostname for c in self.containers ]
+        args = [ "pssh", "-i", "-p", str(max_workers),
+                 "-t", str(timeout if timeout else 0),
+                 "-O", "StrictHostKeyChecking=no",
+                 "-H", " ".join(hosts), cmd ]
+        cont = self.containers[-1]
+        rc, stream = cont.exec_run(args, stream = True)
+        cur = None # [ host, rc, lines ]
+        buf = ""
+        def _lines():
+            nonlocal buf
+            for chunk in stream:
+                buf += chunk.decode(errors = "replace")
+                *lines, buf = buf.split("\n")
+                yield from lines
+            if buf:
+                yield buf
+        for l in _lines():
+            m = self._PSSH_HDR_RE.match(l)
+            if not m:
+                if cur:
+                    cur[2].append(l)
+                continue
+            if cur:
+                yield cur[0], cur[1], "\n".join(cur[2])
+            msg = m.group("msg")
+            if m.group("status") == "SUCCESS":
+                _rc = 0
+            elif "Timed out" in msg:
+                _rc = 124
+            else:
+                em = re.search(r'error code (\d+)', msg)
+                _rc = int(em.group(1)) if em else -1
+            cur = [ m.group("host"), _rc, [] ]
+        if cur:
+            yield cur[0], cur[1], "\n".join(cur[2])
+
+    def all_exec_run(self, cmd, max_workers = 16, timeout = None,
+                     mode = "docker", aggregate = False):
+        """Execute `cmd` on all containers concurrently
+
+        See `fan_out_exec()` for the parameters. Returns { HOSTNAME : (rc,
+        output) }, or the `dshbak()` grouping of it [ (HOSTLIST, (rc,
+        output)), ... ] if `aggregate` is True.
+        """
+        res = { h: (rc, out) for h, rc, out in \
+                self.fan_out_exec(cmd, max_workers = max_workers,
+                                  timeout = timeout, mode = mode) }
+        return dshbak(res) if aggregate else res
 
     @cached_property
     def ldmsd_version(self):
@@ -2447,60 +3917,445 @@ class Munged(object):
             self.pid_file = "/run/munge/munged.pid"
             self.sock_file = "/run/munge/munge.socket.2"
 
-    def _prep_dom(self):
-        cont = self.cont
-        _dir = "/munge/{}".format(self.dom) if self.dom else "/run/munge"
-        rc, out = cont.exec_run("mkdir -p {}".format(_dir))
+    DEFAULT_KEY = "0"*4096 # used if no key is given and no key file exists
+
+    @property
+    def run_dir(self):
+        return "/munge/{}".format(self.dom) if self.dom else "/run/munge"
+
+    def _script_running(self):
+        """(private) bash condition: munged is running"""
+        return "[[ -f {pid} ]] && ps -p $(cat {pid}) >/dev/null 2>&1" \
+               .format(pid = self.pid_file)
+
+    def start_script(self):
+        """The bash script starting munged in a single exec
+
+        The script does nothing if munged is already running. Otherwise, it
+        prepares the domain directory and the key file (the key is embedded
+        as base64; the existing key file is kept if no key is given), and
+        starts munged as `munge` user.
+        """
+        if self.key:
+            key = self.key.encode() if type(self.key) == str else self.key
+            prep_key = "echo {b64} | base64 -d > {key}"
+        else:
+            key = self.DEFAULT_KEY.encode()
+            prep_key = "[[ -f {key} ]] || ( echo {b64} | base64 -d > {key} )"
+        prep_key = prep_key.format(key = self.key_file,
+                                   b64 = base64.b64encode(key).decode())
+        cmd = "munged"
+        if self.dom:
+            cmd += " -S {sock} --pid-file {pid} --key-file {key}"\
+                   .format( sock = self.sock_file, pid = self.pid_file,
+                            key = self.key_file )
+        return "\n".join([
+                "set -e",
+                "if {}; then exit 0; fi".format(self._script_running()),
+                "mkdir -p {0} $(dirname {1})".format(self.run_dir,
+                                                     self.key_file),
+                "chown munge:munge {}".format(self.run_dir),
+                prep_key,
+                "chown munge:munge {0}; chmod 600 {0}".format(self.key_file),
+                "su -s /bin/bash munge -c '{}'".format(cmd),
+            ])
+
+    def kill_script(self):
+        """The bash script killing munged in a single exec"""
+        return "if {}; then kill $(cat {}); fi" \
+               .format(self._script_running(), self.pid_file)
+
+    @classmethod
+    def run_scripts(cls, cont, scripts):
+        """Run `scripts` (each in a subshell) in a single exec in `cont`"""
+        script = "set -e\n" + "\n".join( "(\n{}\n)".format(x) \
+                                          for x in scripts )
+        rc, out = cont.exec_run(["/bin/bash", "-c", script])
         if rc:
-            raise RuntimeError("Cannot create directory '{}', rc: {}, out: {}"\
-                               .format(_dir, rc, out))
-        self.cont.chown("munge:munge", _dir)
-
-    def _prep_key_file(self):
-        _key = self.key
-        if not _key: # key not given
-            rc, out = self.cont.exec_run("ls {}".format(self.key_file))
-            if rc == 0: # file existed, and no key given .. use existing key
-                return
-            _key = "0"*4096 # use default key if key_file not existed
-        self.cont.write_file(self.key_file, _key, user = "munge")
-        self.cont.chmod(0o600, self.key_file)
+            raise RuntimeError("munged script error, rc: {}, out: {}" \
+                               .format(rc, out))
+        return out
 
     def get_pid(self):
         """PID of the running munged, `None` if it is not running"""
-        rc, out = self.cont.exec_run("cat {}".format(self.pid_file))
+        rc, out = self.cont.exec_run(["/bin/bash", "-c",
+                    "{} && cat {}".format(self._script_running(),
+                                          self.pid_file)])
         if rc:
             return None
         return int(out)
 
     def is_running(self):
         """Returns `True` if munged is running"""
-        pid = self.get_pid()
-        if not pid:
-            return False
-        rc, out = self.cont.exec_run("ps -p {}".format(pid))
-        return rc == 0
+        return self.get_pid() is not None
 
     def start(self):
         """Start the daemon"""
-        if self.is_running():
-            return # do nothing
-        self._prep_dom()
-        self._prep_key_file()
-        cmd = "munged"
-        if self.dom:
-            cmd += " -S {sock} --pid-file {pid} --key-file {key}"\
-                   .format( sock = self.sock_file, pid = self.pid_file,
-                            key = self.key_file )
-        rc, out = self.cont.exec_run(cmd, user = "munge")
-        if rc:
-            raise RuntimeError("`{}` error, rc: {}, out: {}"\
-                               .format(cmd, rc, out))
+        self.run_scripts(self.cont, [ self.start_script() ])
 
     def kill(self):
         """Kill the daemon"""
-        pid = self.get_pid()
-        self.cont.exec_run("kill {}".format(pid))
+        self.run_scripts(self.cont, [ self.kill_script() ])
+
+    @classmethod
+    def start_all(cls, cont, munged_list):
+        """Start all munged's in `munged_list` in `cont` in a single exec"""
+        cls.run_scripts(cont, [ m.start_script() for m in munged_list ])
+
+
+class LDMSDController(object):
+    """LDMSDController(cont, timeout = 10, retry = 1)
+
+    A persistent `ldmsd_controller` session to the ldmsd in the container
+    `cont` (LDMSDContainer). `cont.config_ldmsd()` spawns a new
+    `ldmsd_controller` (and a new LDMS connection) for every call, while the
+    session keeps one `ldmsd_controller` process connected to ldmsd and
+    pipelines the commands through its stdin.
+
+    Each command is followed by a `greeting name=TOKEN` command with a unique
+    TOKEN. The response of the command is all the output before the
+    `greeting` response ("Hello 'TOKEN'"). If `ldmsd_controller` exits
+    (e.g. ldmsd was restarted), the session reconnects (up to `retry` times)
+    and resends the commands that have not been responded only if they are
+    read-only (`READONLY_RE`, e.g. `prdcr_status`). A command that changes
+    ldmsd (e.g. `prdcr_add`) may have been applied before the session broke,
+    so a `RuntimeError` is raised instead of resending it.
+
+    Application does not normally create LDMSDController directly, but uses
+    `cont.controller()` which caches the session in the cluster object.
+
+    Examples:
+    >>> ctrl = cont.controller()
+    >>> out = ctrl.command("prdcr_status")
+    >>> outs = ctrl.commands([ "prdcr_stop name=node-1",
+    ...                        "prdcr_start name=node-1" ])
+    >>> ctrl.close()
+    """
+    GREETING = "Hello '{}'" # the response of `greeting name=TOKEN`
+    # an error response of ldmsd as printed by `ldmsd_controller`
+    ERROR_RE = re.compile(r"^\s*Error\b", re.M | re.I)
+    # the commands that are safe to resend after a reconnect
+    READONLY_RE = re.compile(r"^\s*(\w+_status|\w+_stats|version|greeting|"
+                             r"usage|help)(\s|$)")
+
+    def __init__(self, cont, timeout = 10, retry = 1):
+        self.cont = cont
+        self.timeout = timeout
+        self.retry = retry
+        self.sockio = None
+        self.sock = None
+        self.raw = b"" # multiplexed data not demuxed yet
+        self.buf = b"" # demuxed output (stdout and stderr) not consumed yet
+        self.err_at = [] # the offsets in `buf` of the stderr output
+        self.prompt = b""
+        self.nonce = os.urandom(4).hex()
+        self.seq = 0
+
+    def __del__(self):
+        self.close()
+
+    def _token(self):
+        self.seq += 1
+        return "ctrl{}x{}".format(self.nonce, self.seq)
+
+    def _recv(self):
+        """Receive and demux the docker exec stream into `self.buf`
+
+        The stream is multiplexed into frames, each of which has an 8-byte
+        header: STREAM_TYPE(1), 0(3), SIZE(4, big endian).
+        """
+        data = self.sock.recv(65536)
+        if not data:
+            raise EOFError("ldmsd_controller session closed")
+        self.raw += data
+        while len(self.raw) >= 8:
+            sz, = struct.unpack(">I", self.raw[4:8])
+            if len(self.raw) < 8 + sz:
+                break
+            if self.raw[0] == 2 and sz: # stderr
+                self.err_at.append(len(self.buf))
+            self.buf += self.raw[8:8+sz]
+            self.raw = self.raw[8+sz:]
+
+    def _read_until(self, token):
+        """Consume the output through the greeting response of `token`
+
+        Returns the output before the greeting response with the prompts
+        removed. `self.last_err` tells whether any of it came from stderr.
+        """
+        marker = self.GREETING.format(token).encode()
+        while True:
+            i = self.buf.find(marker)
+            if i >= 0:
+                j = self.buf.find(b"\n", i + len(marker))
+                if j >= 0:
+                    break
+            self._recv()
+        out = self.buf[:i]
+        self.buf = self.buf[j+1:]
+        self.last_err = any( p < i for p in self.err_at )
+        self.err_at = [ p - (j+1) for p in self.err_at if p > j ]
+        if self.prompt:
+            out = out.replace(self.prompt, b"")
+        return out.decode()
+
+    def _send(self, cmds, tokens):
+        data = "".join( "{}\ngreeting name={}\n".format(c, t) \
+                        for c, t in zip(cmds, tokens) )
+        self.sock.sendall(data.encode())
+
+    def connect(self):
+        """(Re)connect the session"""
+        self.close()
+        xprt, port, auth = self.cont.ldmsd_listen
+        cmd = "bash -c 'exec ldmsd_controller --host {host} --xprt {xprt} " \
+              "--port {port} --auth {auth}'" \
+              .format(host = self.cont.hostname, xprt = xprt, port = port,
+                      auth = auth)
+        # unbuffered, so that the responses are not held in the pipe buffer
+        rc, self.sockio = self.cont.exec_run(cmd, stdin = True, socket = True,
+                                environment = { "PYTHONUNBUFFERED": "1" })
+        self.sock = self.sockio._sock
+        self.sock.setblocking(True)
+        self.sock.settimeout(self.timeout)
+        # The prompt is the output between two consecutive greetings.
+        t0, t1 = self._token(), self._token()
+        self.sock.sendall("greeting name={}\ngreeting name={}\n" \
+                          .format(t0, t1).encode())
+        self._read_until(t0)
+        self.prompt = self._read_until(t1).encode()
+
+    def close(self):
+        """Close the session (terminating `ldmsd_controller`)"""
+        if self.sock:
+            try:
+                self.sock.shutdown(socket.SHUT_WR)
+                self.sockio.close()
+                self.sock.close()
+            except OSError:
+                pass
+        self.sock = self.sockio = None
+        self.raw = self.buf = self.prompt = b""
+        self.err_at = []
+
+    def commands(self, cmds):
+        """Pipeline `cmds` and return the list of their outputs (`str`)"""
+        return [ out for out, err in self._commands(cmds) ]
+
+    def _commands(self, cmds):
+        """Pipeline `cmds` and return the list of (output, stderr_seen)"""
+        if type(cmds) not in (list, tuple):
+            cmds = [ cmds ]
+        outs = []
+        attempt = 0
+        while len(outs) < len(cmds):
+            sent = False
+            try:
+                if not self.sock:
+                    self.connect()
+                pending = cmds[len(outs):]
+                tokens = [ self._token() for c in pending ]
+                sent = True # (possibly partially) delivered from here on
+                self._send(pending, tokens)
+                for t in tokens:
+                    out = self._read_until(t)
+                    outs.append((out, self.last_err))
+            except socket.timeout:
+                self.close()
+                raise RuntimeError("{}: ldmsd_controller response timeout" \
+                                   .format(self.cont.hostname))
+            except (EOFError, OSError) as e:
+                self.close()
+                unsafe = [ c for c in cmds[len(outs):] \
+                             if not self.READONLY_RE.match(c) ] if sent else []
+                if unsafe:
+                    raise RuntimeError("{}: ldmsd_controller session error: "
+                                       "{}; `{}` may or may not have been "
+                                       "applied ({} of {} commands "
+                                       "responded), not resending" \
+                                       .format(self.cont.hostname, e,
+                                               unsafe[0], len(outs),
+                                               len(cmds)))
+                if attempt >= self.retry:
+                    raise RuntimeError("{}: ldmsd_controller session error: {}"\
+                                       .format(self.cont.hostname, e))
+                attempt += 1
+                log.info("{}: reconnecting ldmsd_controller session ({})" \
+                         .format(self.cont.hostname, e))
+        return outs
+
+    def command(self, cmd):
+        """Execute a single command and return its output (`str`)"""
+        return self.commands([ cmd ])[0]
+
+    def config_ldmsd(self, cmds):
+        """A drop-in replacement of `LDMSDContainer.config_ldmsd()`
+
+        Returns (RC, OUTPUT) where OUTPUT is the concatenated outputs of
+        `cmds`. Like `LDMSDContainer.config_ldmsd()`, RC is 2 if any command
+        wrote to stderr. RC is 1 if ldmsd responded to any command with an
+        error (`ERROR_RE`), and 0 otherwise.
+        """
+        rc = 0
+        outs = []
+        for out, err in self._commands(cmds):
+            if err:
+                rc = 2
+            elif not rc and self.ERROR_RE.search(out):
+                rc = 1
+            outs.append(out)
+        return rc, "".join(outs)
+
+class ResourceSampler(threading.Thread):
+    """ResourceSampler(cluster, path, interval = 1.0, procs = PROCS)
+
+    A background thread sampling the resource usage of the containers of
+    `cluster` (LDMSDCluster) every `interval` seconds while the test runs:
+    - docker stats of each container: CPU (%), memory (bytes), network
+      rx/tx bytes and block IO read/write bytes, and
+    - RSS (kB) and CPU (%) of each of `procs` processes in each container
+      from `/proc`.
+
+    Each sample of each container is a JSON line in `path`:
+    {"ts", "host", "tier", "cpu", "mem", "net_rx", "net_tx", "blk_r", "blk_w",
+     "procs": [ {"name", "pid", "rss", "cpu"}, ... ]}
+
+    `stop()` stops the thread and returns the per-tier summary (see
+    `summary()`), which is also saved as `path` with ".summary.json" suffix
+    (replacing ".jsonl"). Note that a docker stats query takes about a
+    second, so the effective interval is at least that long.
+
+    Application normally uses `cluster.start_resource_sampler()`.
+    """
+    PROCS = ("ldmsd", "munged", "slurmd", "slurmctld")
+
+    # one exec per sample: "NAME PID RSS_KB CPU_TICKS CLK_TCK" for each proc
+    PROC_SCRIPT = """
+T=$(getconf CLK_TCK)
+for p in $(pgrep -x '{procs}'); do
+  n=$(cat /proc/$p/comm 2>/dev/null) || continue
+  r=$(awk '/^VmRSS/{{print $2}}' /proc/$p/status 2>/dev/null)
+  c=$(sed 's/.*) //' /proc/$p/stat 2>/dev/null | awk '{{print $12+$13}}')
+  echo "$n $p ${{r:-0}} ${{c:-0}} $T"
+done
+"""
+
+    def __init__(self, cluster, path, interval = 1.0, procs = PROCS):
+        super(ResourceSampler, self).__init__(name = "resource_sampler")
+        self.daemon = True
+        self.cluster = cluster
+        self.path = path
+        self.interval = interval
+        self.script = self.PROC_SCRIPT.format(procs = "|".join(procs))
+        self.tiers = cluster.ldmsd_tiers()
+        self.conts = cluster.containers
+        self.ticks = dict() # (host, pid) : (ts, ticks)
+        self.records = []
+        self._stop_ev = threading.Event()
+
+    @staticmethod
+    def _docker_stats(st):
+        """(private) Extract the numbers from docker stats `st`"""
+        cpu = st.get("cpu_stats", {})
+        pre = st.get("precpu_stats", {})
+        cpu_delta = cpu.get("cpu_usage", {}).get("total_usage", 0) - \
+                    pre.get("cpu_usage", {}).get("total_usage", 0)
+        sys_delta = cpu.get("system_cpu_usage", 0) - \
+                    pre.get("system_cpu_usage", 0)
+        ncpu = cpu.get("online_cpus") or \
+               len(cpu.get("cpu_usage", {}).get("percpu_usage") or [1])
+        mem = st.get("memory_stats", {})
+        # the page cache is excluded as the docker CLI does: "inactive_file"
+        # (cgroup v2) or "total_inactive_file" (cgroup v1)
+        mstats = mem.get("stats", {})
+        inactive = mstats.get("inactive_file",
+                              mstats.get("total_inactive_file", 0))
+        nets = (st.get("networks") or {}).values()
+        blk = st.get("blkio_stats", {}).get("io_service_bytes_recursive") or []
+        return dict(
+            cpu = 100.0 * cpu_delta / sys_delta * ncpu if sys_delta > 0 else 0.0,
+            mem = mem.get("usage", 0) - inactive,
+            net_rx = sum( n.get("rx_bytes", 0) for n in nets ),
+            net_tx = sum( n.get("tx_bytes", 0) for n in nets ),
+            blk_r = sum( b["value"] for b in blk if b.get("op") == "Read" ),
+            blk_w = sum( b["value"] for b in blk if b.get("op") == "Write" ),
+        )
+
+    def _procs(self, cont, ts):
+        """(private) Per-process RSS and CPU from /proc of `cont`"""
+        rc, out = cont.exec_run(["/bin/bash", "-c", self.script])
+        procs = []
+        for l in out.splitlines():
+            try:
+                name, pid, rss, ticks, tck = l.split()
+                pid, rss, ticks, tck = int(pid), int(rss), int(ticks), int(tck)
+            except ValueError:
+                continue
+            key = (cont.hostname, pid)
+            prev = self.ticks.get(key)
+            self.ticks[key] = (ts, ticks)
+            cpu = None
+            if prev and ts > prev[0]:
+                cpu = 100.0 * (ticks - prev[1]) / tck / (ts - prev[0])
+            procs.append(dict(name = name, pid = pid, rss = rss, cpu = cpu))
+        return procs
+
+    def _sample(self, cont):
+        ts = time.time()
+        try:
+            rec = self._docker_stats(cont.obj.stats(stream = False))
+            rec["procs"] = self._procs(cont, ts)
+        except Exception as e:
+            log.debug("resource sample error, {}: {}".format(cont.hostname, e))
+            return None
+        rec.update(ts = ts, host = cont.hostname,
+                   tier = self.tiers.get(cont.hostname))
+        return rec
+
+    def run(self):
+        with open(self.path, "w") as f:
+            while not self._stop_ev.is_set():
+                t0 = time.time()
+                for rec in parallel_map(self._sample, self.conts):
+                    if not rec:
+                        continue
+                    self.records.append(rec)
+                    f.write(json.dumps(rec, separators = (",", ":")) + "\n")
+                f.flush()
+                self._stop_ev.wait(max(0, self.interval - (time.time() - t0)))
+
+    def stop(self):
+        """Stop sampling, save and return the summary"""
+        self._stop_ev.set()
+        self.join()
+        summ = self.summary()
+        with open(re.sub(r'\.jsonl$', '', self.path) + ".summary.json",
+                  "w") as f:
+            json.dump(summ, f, indent = 1)
+        return summ
+
+    def summary(self, proc = "ldmsd"):
+        """Per-tier summary of the samples
+
+        Returns { TIER : { "samples", "hosts", "cpu_mean", "mem_peak",
+        "PROC_rss_peak", "PROC_cpu_mean" } } where "cpu_mean" and "mem_peak"
+        are of the containers (%, bytes), and the PROC_* are of the `proc`
+        processes (kB, %).
+        """
+        summ = dict()
+        for tier in sorted(set( str(r["tier"]) for r in self.records )):
+            recs = [ r for r in self.records if str(r["tier"]) == tier ]
+            prs = [ p for r in recs for p in r["procs"] if p["name"] == proc ]
+            cpus = [ p["cpu"] for p in prs if p["cpu"] is not None ]
+            summ[tier] = {
+                "samples": len(recs),
+                "hosts": len(set( r["host"] for r in recs )),
+                "cpu_mean": sum( r["cpu"] for r in recs ) / len(recs),
+                "mem_peak": max( r["mem"] for r in recs ),
+                proc + "_rss_peak": max( [ p["rss"] for p in prs ] or [0] ),
+                proc + "_cpu_mean": sum(cpus) / len(cpus) if cpus else 0.0,
+            }
+        return summ
 
 
 class ContainerTTY(object):
@@ -7,6 +7,7 @@ import json
 import socket
 import hashlib
 import binascii
+import threading
 import subprocess
 import warnings
 
@@ -23,6 +24,9 @@ warnings.filterwarnings('ignore') # to suppress mysql bogus warnings
 
 LOGIN = pwd.getpwuid(os.geteuid())[0]
 DEBUG = False
+BUFFERED = False # the default `buffered` of `Test`
+SPOOL_DIR = None # the default `spool_dir` of `Test`
+SPOOL_FILE = "tada-spool-{test_name}.jsonl" # formatted with the Test attributes
 
 TERM_RESET  = '\033[0m'
 TERM_BOLD   = '\033[1m'
@@ -35,6 +39,35 @@ TERM_TEAL   = '\033[36m'
 
 class AssertionException(Exception): pass
 
+TADA_PORT = 9862
+TADA_XPRTS = [ "udp", "tcp", "unix" ]
+TADA_HOST_RE = re.compile(r'^(?P<host>[^:/]+)(?:[:](?P<port>\d+))?$')
+
+def parse_tada_addr(addr):
+    """Parse the `tadad` address into (XPRT, HOST, PORT)
+
+    The address formats are:
+      - "HOST[:PORT]" or "udp://HOST[:PORT]" - UDP datagrams (the default)
+      - "tcp://HOST[:PORT]" - newline-delimited JSON over TCP
+      - "unix://PATH" - newline-delimited JSON over a Unix socket; HOST is
+        the PATH and PORT is `None`
+    The default PORT is 9862.
+    """
+    xprt, sep, rest = addr.partition("://")
+    if not sep:
+        xprt, rest = "udp", addr
+    if xprt not in TADA_XPRTS:
+        raise ValueError("Unsupported tada_addr scheme: {}".format(xprt))
+    if xprt == "unix":
+        if not rest:
+            raise ValueError("Bad address format: {}".format(addr))
+        return (xprt, rest, None)
+    m = TADA_HOST_RE.match(rest)
+    if not m:
+        raise ValueError("Bad address format: {}".format(addr))
+    port = m.group("port")
+    return (xprt, m.group("host"), int(port) if port else TADA_PORT)
+
 class Test(object):
     """TADA Test Utility
 
@@ -44,11 +77,21 @@ class Test(object):
       - test_type : str
       - test_name : str
     And, optionally specify:
-      - tada_addr : "ADDR:PORT" - for `tadad` connection
+      - tada_addr : "ADDR:PORT" - for `tadad` connection. "tcp://ADDR:PORT" or
+        "unix://PATH" sends the messages over a stream connection instead of
+        UDP (see `parse_tada_addr()`).
       - test_user : str - to specify `user` running the test
         (default `{LOGIN}`)
       - commit_id : str - to specify the commit_id of the target program in
         testing.
+      - buffered : bool - accumulate the messages and send them in batches
+        (of `FLUSH_BATCH` messages, every `FLUSH_INTERVAL` seconds and at
+        `finish()`) instead of one by one (default: `TADA.BUFFERED`). Over
+        UDP, a datagram carries several newline-separated messages.
+      - spool_dir : str - also write every message to
+        `tada-spool-{test_name}.jsonl` in this directory (rewritten by each
+        run) so that the results can be imported later with
+        `tadad --ingest` if `tadad` was down (default: `TADA.SPOOL_DIR`).
 
     (test_suite, test_type, test_name, test_user, commit_id) combination is used
     to identify the test in `tadad` database. This means that re-running the
@@ -66,6 +109,10 @@ class Test(object):
     >>> test.assert_test(3, False) # this send assertion event to `tadad`
     >>> test.finish() # this send all skipped assertions to `tadad`, and
     >>>               # finally send `finish` event to `tadad`
+
+    Numeric results (e.g. latency or throughput of a benchmark) are reported
+    with `report_metric()` between `start()` and `finish()`:
+    >>> test.report_metric("update_lag.p99", 0.012, "sec", {"tier": "L1"})
     """ % { "LOGIN": LOGIN }
 
     PASSED  = "passed"
@@ -75,9 +122,16 @@ class Test(object):
     FAILED_COLOR  = TERM_BOLD + TERM_RED    + "failed"  + TERM_RESET
     SKIPPED_COLOR = TERM_BOLD + TERM_YELLOW + "skipped" + TERM_RESET
 
+    STREAM_BATCH = 64    # messages per write on the stream transports
+    STREAM_RETRIES = 3   # reconnect attempts before giving up on `tadad`
+    ACK_TIMEOUT = 30     # seconds to wait for the `test-finish` ack
+    FLUSH_BATCH = 64     # buffered messages that trigger a flush
+    FLUSH_INTERVAL = 5.0 # seconds between the timed flushes
+    UDP_MAX = 60000      # max bytes of the messages packed in a datagram
+
     def __init__(self, test_suite, test_type, test_name, test_desc = None,
                  tada_addr="localhost:9862", test_user=LOGIN,
-                 commit_id="-"):
+                 commit_id="-", buffered=None, spool_dir=None):
         self.test_suite = test_suite
         self.test_type = test_type
         self.test_name = test_name
@@ -85,17 +139,24 @@ class Test(object):
         self.commit_id = commit_id
         self.test_desc = test_desc if test_desc else test_name
         if tada_addr is None:
-            self.tada_host = "localhost"
-            self.tada_port = 9862
-        else:
-            s = tada_addr.split(':')
-            self.tada_host = s[0]
-            if len(s) > 1:
-                self.tada_port = int(s[1])
-            else:
-                self.tada_port = 9862
+            tada_addr = "localhost:{}".format(TADA_PORT)
+        self.tada_xprt, self.tada_host, self.tada_port = \
+                                                parse_tada_addr(tada_addr)
         self.assertions = dict()
-        self.sock_fd = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.buffered = BUFFERED if buffered is None else buffered
+        self.spool_dir = SPOOL_DIR if spool_dir is None else spool_dir
+        self._spool = None
+        self._pending = [] # buffered messages
+        self._lock = threading.Lock()
+        self._flusher = None
+        if self.tada_xprt == "udp":
+            self.sock_fd = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        else:
+            self.sock_fd = None # connected by the first flush
+            self._history = [] # all lines of the test, resent on reconnect
+            self._wbuf = [] # lines not yet written
+            self._rbuf = b""
+            self._stream_down = False
 
     def _send(self, msg):
         msg["test-id"] = self.test_id
@@ -105,7 +166,141 @@ class Test(object):
             msg = msg.encode()
         else:
             msg = json.dumps(msg).encode()
-        self.sock_fd.sendto(msg, (self.tada_host, self.tada_port))
+        if self._spool:
+            self._spool.write(msg + b"\n")
+            self._spool.flush()
+        if not self.buffered:
+            with self._lock:
+                self._xmit([ msg ])
+            return
+        with self._lock:
+            self._pending.append(msg)
+            full = len(self._pending) >= self.FLUSH_BATCH
+        if full:
+            self.flush()
+
+    def flush(self):
+        """Send the buffered messages now"""
+        with self._lock:
+            msgs, self._pending = self._pending, []
+            if msgs:
+                self._xmit(msgs)
+
+    def _flush_loop(self):
+        while not self._flush_stop.wait(self.FLUSH_INTERVAL):
+            self.flush()
+
+    def _datagrams(self, msgs):
+        """Pack `msgs` into newline-separated datagrams of up to `UDP_MAX`"""
+        dgram, size = [], 0
+        for m in msgs:
+            if dgram and size + len(m) + 1 > self.UDP_MAX:
+                yield b"\n".join(dgram)
+                dgram, size = [], 0
+            dgram.append(m)
+            size += len(m) + 1
+        if dgram:
+            yield b"\n".join(dgram)
+
+    def _xmit(self, msgs):
+        """Transmit the encoded messages (the caller holds `_lock`)"""
+        if self.tada_xprt == "udp":
+            for dgram in self._datagrams(msgs):
+                try:
+                    self.sock_fd.sendto(dgram, (self.tada_host, self.tada_port))
+                except OSError as e: # e.g. EMSGSIZE
+                    log.warning("cannot send a {} bytes message to tadad: {}; "
+                                "consider tcp://{}:{}".format(len(dgram), e,
+                                    self.tada_host, self.tada_port))
+            return
+        for msg in msgs:
+            line = msg + b"\n"
+            self._history.append(line)
+            self._wbuf.append(line)
+        if self.buffered or len(self._wbuf) >= self.STREAM_BATCH:
+            self._flush()
+
+    def _close(self):
+        if self.sock_fd:
+            self.sock_fd.close()
+        self.sock_fd = None
+        self._rbuf = b""
+
+    def _connect(self):
+        if self.tada_xprt == "unix":
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            addr = self.tada_host
+        else:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            addr = (self.tada_host, self.tada_port)
+        sock.settimeout(self.ACK_TIMEOUT)
+        try:
+            sock.connect(addr)
+        except:
+            sock.close()
+            raise
+        self.sock_fd = sock
+
+    def _flush(self):
+        """Write the buffered lines to the stream; on (re)connect, the whole
+        test is (re)sent from `test-start`. Returns False if `tadad` is
+        unreachable."""
+        if self._stream_down:
+            self._wbuf = []
+            return False
+        for attempt in range(self.STREAM_RETRIES + 1):
+            if attempt:
+                time.sleep(0.5 * 2**(attempt - 1))
+            try:
+                if self.sock_fd is None:
+                    self._connect()
+                    data = b"".join(self._history)
+                else:
+                    data = b"".join(self._wbuf)
+                self.sock_fd.sendall(data)
+                self._wbuf = []
+                return True
+            except OSError as e:
+                log.warning("tadad connection error: {}".format(e))
+                self._close()
+        log.warning("cannot send the results to tadad, giving up")
+        self._stream_down = True
+        self._wbuf = []
+        return False
+
+    def _wait_ack(self):
+        """Wait for the `ack` of `test-finish` from `tadad`"""
+        while True:
+            line, sep, rest = self._rbuf.partition(b"\n")
+            if sep:
+                self._rbuf = rest
+                msg = json.loads(line)
+                if msg.get("msg-type") == "ack" and \
+                        msg.get("test-id") == self.test_id:
+                    return msg
+                continue
+            data = self.sock_fd.recv(4096)
+            if not data:
+                raise ConnectionError("connection closed by tadad")
+            self._rbuf += data
+
+    def _finish_stream(self):
+        for attempt in range(self.STREAM_RETRIES + 1):
+            if not self._flush():
+                return
+            try:
+                ack = self._wait_ack()
+                if ack.get("status") != "stored":
+                    log.warning("tadad failed to store the test: {}" \
+                                .format(ack.get("status")))
+                break
+            except (OSError, ValueError) as e:
+                # reconnect and resend the test in the next `_flush()`
+                log.warning("no ack from tadad: {}".format(e))
+                self._close()
+        else:
+            log.warning("the test is not acknowledged by tadad")
+        self._close()
 
     def start(self):
         s = "{t.test_suite}:{t.test_type}:{t.test_name}:{t.test_user}:" \
@@ -117,6 +312,22 @@ class Test(object):
         log.info("  test-name: {}".format(self.test_name))
         log.info("  test-user: {}".format(self.test_user))
         log.info("  commit-id: {}".format(self.commit_id))
+        if self.spool_dir:
+            path = os.path.join(self.spool_dir,
+                                SPOOL_FILE.format(**self.__dict__))
+            try:
+                # only this run, so that `tadad --ingest` does not store the
+                # previous runs again
+                self._spool = open(path, "wb")
+                log.info("  spool: {}".format(path))
+            except OSError as e:
+                log.warning("cannot open the spool file {}: {}" \
+                            .format(path, e))
+        if self.buffered:
+            self._flush_stop = threading.Event()
+            self._flusher = threading.Thread(target = self._flush_loop,
+                                             daemon = True)
+            self._flusher.start()
         msg = {
                 "msg-type": "test-start",
                 "test-suite": self.test_suite,
@@ -156,6 +367,24 @@ class Test(object):
         if not cond and DEBUG:
             raise AssertionException(self.test_desc + ", " + cond_str + ": FAILED")
 
+    def report_metric(self, name, value, unit = "", tags = None):
+        """Report a numeric result `value` of the metric `name`
+
+        `unit` is a free-form string (e.g. "sec", "msgs/sec", "bytes") and
+        `tags` is an optional { KEY: VALUE } dictionary distinguishing the
+        values of the same metric within the test (e.g. { "tier": "L1" }).
+        """
+        msg = {
+                "msg-type": "metric",
+                "metric-name": name,
+                "metric-value": float(value),
+                "metric-unit": unit,
+                "metric-tags": tags if tags else {},
+                "timestamp": time.time(),
+              }
+        self._send(msg)
+        log.info("metric {}: {} {}".format(metric_key(name, tags), value, unit))
+
     def finish(self):
         for num, msg in self.assertions.items():
             if msg["test-status"] == Test.SKIPPED:
@@ -169,8 +398,34 @@ class Test(object):
                 "timestamp": time.time(),
               }
         self._send(msg)
+        if self._flusher:
+            self._flush_stop.set()
+            self._flusher.join()
+            self._flusher = None
+        self.flush()
+        if self.tada_xprt != "udp":
+            with self._lock:
+                self._finish_stream()
+        if self._spool:
+            self._spool.close()
+            self._spool = None
         log.info("test {} ended".format(self.test_name))
 
+def metric_tags_str(tags):
+    """Canonical string of the metric tags: "K0=V0,K1=V1" (sorted by keys)"""
+    if not tags:
+        return ""
+    return ",".join( "{}={}".format(k, tags[k]) for k in sorted(tags) )
+
+def metric_key(name, tags):
+    """The metric name with the tags, e.g. "update_lag.p99{tier=L1}"
+
+    `tags` is either the { KEY: VALUE } dictionary or its `metric_tags_str()`.
+    """
+    if type(tags) == dict:
+        tags = metric_tags_str(tags)
+    return "{}{{{}}}".format(name, tags) if tags else name
+
 class SQLModel(object):
     """SQL data model base class
 
@@ -325,6 +580,38 @@ class SQLModel(object):
         _conn.commit()
         return cls.get(_conn, **_id)
 
+    @classmethod
+    def _sql_upsert_statement(cls, _conn, cols):
+        """INSERT statement of `cols` updating the row of the same ids"""
+        mod = conn_module(_conn)
+        upsert, update = UPSERT_TBL[mod.__name__]
+        if mod.__name__ == "sqlite3" and mod.sqlite_version_info < (3, 24, 0):
+            # no UPSERT in old sqlite; all columns are given anyway
+            upsert = "INSERT OR REPLACE INTO {table} ({cols}) VALUES ({vals})"
+        updates = [ update.format(c) for c in cols if c not in cls.__ids__ ]
+        if not updates: # nothing to update, just keep the existing row
+            updates = [ update.format(c) for c in cls.__ids__[:1] ]
+        return upsert.format(table = cls.__table__, cols = ",".join(cols),
+                    vals = ",".join( [conn_qparam(_conn)] * len(cols) ),
+                    ids = ",".join(cls.__ids__), updates = ", ".join(updates))
+
+    @classmethod
+    def upsert(cls, _conn, rows):
+        """Insert or update (by the primary key) the `rows` in one `executemany`
+
+        `rows` is a list of { COL_NAME: VALUE } having the same columns. Unlike
+        `create()` and `commit()`, this does not commit the transaction so that
+        the caller can group several upserts into one transaction.
+        """
+        if not rows:
+            return
+        cols = [ c for c, t in cls.__cols__ if c in rows[0] ]
+        sql = cls._sql_upsert_statement(_conn, cols)
+        params = [ tuple( None if r[c] is None else str(r[c]) for c in cols ) \
+                   for r in rows ]
+        cur = _conn.cursor()
+        cur.executemany(sql, params)
+
     def __cmp__(self, other):
         for k in self.__colnames__:
             a0 = getattr(self, k)
@@ -461,6 +748,24 @@ class TADATestModel(SQLModel):
         cur.execute(sql, [str(self.test_id)])
         return [ TADAAssertionModel(self._conn, d) for d in cur.fetchall() ]
 
+    @property
+    def metrics(self):
+        """all metrics belong to this test"""
+        sql = "SELECT * FROM {} WHERE test_id={}" \
+              .format(TADAMetricModel.__table__, self._qparam)
+        cur = self._conn.cursor()
+        cur.execute(sql, [str(self.test_id)])
+        return [ TADAMetricModel(self._conn, d) for d in cur.fetchall() ]
+
+    def getMetric(self, metric_name, metric_tags = ""):
+        """Get or create a metric"""
+        return TADAMetricModel.get(
+                    self._conn,
+                    test_id = self.test_id,
+                    metric_name = metric_name,
+                    metric_tags = metric_tags
+                )
+
     def getAssertion(self, assert_id):
         """Get or create an assertion"""
         return TADAAssertionModel.get(
@@ -473,6 +778,8 @@ class TADATestModel(SQLModel):
         """Delete the Test and the Assertions from the database"""
         for a in self.assertions:
             a.delete()
+        for m in self.metrics:
+            m.delete()
         super(TADATestModel, self).delete()
 
     def equivalent(self, other):
@@ -498,6 +805,23 @@ class TADAAssertionModel(SQLModel):
     __ids__ = [ "test_id", "assert_id" ]
 
 
+class TADAMetricModel(SQLModel):
+    __table__ = "TADAMetric"
+    __cols__ = [
+             ( "test_id"       , "VARCHAR(64)"      )  ,
+             ( "metric_name"   , "VARCHAR(128)"     )  ,
+             ( "metric_tags"   , "VARCHAR(255)"     )  ,
+             ( "metric_value"  , "DOUBLE PRECISION" )  ,
+             ( "metric_unit"   , "TEXT"             )  ,
+        ]
+    __ids__ = [ "test_id", "metric_name", "metric_tags" ]
+
+    @property
+    def key(self):
+        """The metric name with the tags (see `metric_key()`)"""
+        return metric_key(self.metric_name, self.metric_tags)
+
+
 def conn_module(conn):
     """Get module from connection"""
     m = type(conn).__module__.split('.')[0]
@@ -510,6 +834,22 @@ def conn_qparam(conn):
         return "?"
     return "%s"
 
+# module name : ( upsert statement, update-column format )
+UPSERT_TBL = {
+    "sqlite3": (
+        "INSERT INTO {table} ({cols}) VALUES ({vals}) "
+        "ON CONFLICT({ids}) DO UPDATE SET {updates}",
+        "{0}=excluded.{0}" ),
+    "MySQLdb": (
+        "INSERT INTO {table} ({cols}) VALUES ({vals}) "
+        "ON DUPLICATE KEY UPDATE {updates}",
+        "{0}=VALUES({0})" ),
+    "psycopg2": (
+        "INSERT INTO {table} ({cols}) VALUES ({vals}) "
+        "ON CONFLICT({ids}) DO UPDATE SET {updates}",
+        "{0}=EXCLUDED.{0}" ),
+}
+
 def db_loc(host, port):
     if port:
         return host + ":" + str(port)
@@ -581,6 +921,7 @@ class TADA_DB(object):
     MODELS = [
         TADATestModel,
         TADAAssertionModel,
+        TADAMetricModel,
     ]
 
     def init_tables(self):
@@ -624,6 +965,70 @@ class TADA_DB(object):
         """Get the test macthing the criteria or create a new test if not found"""
         return TADATestModel.get(self.conn, *args, **kwargs)
 
+    def saveTest(self, test, assertions = [], metrics = []):
+        """Store a test with its assertions and metrics in one transaction
+
+        `test` is a { COL_NAME: VALUE } of `TADATestModel` columns (must have
+        "test_id"), and `assertions` and `metrics` are lists of the rows of
+        `TADAAssertionModel` and `TADAMetricModel` respectively. The existing
+        rows with the same ids are updated.
+        """
+        try:
+            TADATestModel.upsert(self.conn, [ test ])
+            TADAAssertionModel.upsert(self.conn, assertions)
+            TADAMetricModel.upsert(self.conn, metrics)
+            self.conn.commit()
+        except:
+            self.conn.rollback()
+            raise
+
+    def _test_cond(self, **kwargs):
+        """(SQL conditions, params) of the test filtering conditions"""
+        qparam = conn_qparam(self.conn)
+        cond = [ "t.{}={}".format(k, qparam) for k in kwargs.keys() ]
+        return cond, list(map(str, kwargs.values()))
+
+    def recentCommits(self, n, exclude = None, **kwargs):
+        """The `n` most recently tested commit IDs (except `exclude`) of the
+        tests matching the filtering conditions, the most recent first"""
+        cond, params = self._test_cond(**kwargs)
+        if exclude:
+            cond.append("t.commit_id<>{}".format(conn_qparam(self.conn)))
+            params.append(str(exclude))
+        sql = "SELECT t.commit_id, MAX(t.test_start) FROM {} t {} " \
+              "GROUP BY t.commit_id ORDER BY MAX(t.test_start) DESC " \
+              "LIMIT {:d}".format(TADATestModel.__table__,
+                        "WHERE " + " and ".join(cond) if cond else "", n)
+        cur = self.conn.cursor()
+        cur.execute(sql, tuple(params))
+        return [ row[0] for row in cur.fetchall() ]
+
+    def metricStats(self, commit_ids, **kwargs):
+        """Aggregate the metrics of all runs of the tests of `commit_ids`
+        matching the filtering conditions
+
+        Returns a list of (test_name, metric_name, metric_tags, metric_unit,
+        runs, AVG(metric_value), AVG(metric_value^2)), one per metric of each
+        test.
+        """
+        if not commit_ids:
+            return []
+        qparam = conn_qparam(self.conn)
+        cond, params = self._test_cond(**kwargs)
+        cond.append("t.commit_id IN ({})" \
+                    .format(",".join([qparam] * len(commit_ids))))
+        params += list(map(str, commit_ids))
+        sql = "SELECT t.test_name, m.metric_name, m.metric_tags, " \
+              "MAX(m.metric_unit), COUNT(*), AVG(m.metric_value), " \
+              "AVG(m.metric_value * m.metric_value) " \
+              "FROM {} t JOIN {} m ON t.test_id = m.test_id WHERE {} " \
+              "GROUP BY t.test_name, m.metric_name, m.metric_tags" \
+              .format(TADATestModel.__table__, TADAMetricModel.__table__,
+                      " and ".join(cond))
+        cur = self.conn.cursor()
+        cur.execute(sql, tuple(params))
+        return cur.fetchall()
+
     def purgeOldTests(self):
         """Purge all old tests"""
         objs = self.findTests()
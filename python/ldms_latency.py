@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+#
+# This script is originally meant to be run by `agg_latency_bench` inside the
+# container that `agg_latency_bench` generates.
+#
+# SYNOPSIS
+#     ldms_latency.py -H HOST[:PORT] [-H HOST[:PORT] ...] -I POLL_INTERVAL \
+#                     -D DURATION [-x XPRT]
+#
+# DESCRIPTION
+#     Connects to all of the given ldmsd's, looks up all of their sets, then
+#     keeps updating the sets every POLL_INTERVAL (micro seconds) for DURATION
+#     (seconds), one thread per ldmsd. Every time the update brings a new
+#     `transaction_timestamp` of a set, the local time of the update is
+#     recorded as the time the sample was first seen at that ldmsd (the
+#     samples present before the polling started are not recorded). Finally,
+#     the records, and the errors of the ldmsd's that failed (e.g. connect
+#     or lookup), are printed in JSON format to STDOUT.
+#
+# OUTPUT FORMAT
+#     {
+#       "records": {
+#         "HOST": [
+#           { "set": NAME, "ts": TRANSACTION_TIMESTAMP, "seen": TIME },
+#           ...
+#         ],
+#         ...
+#       },
+#       "errors": { "HOST": ERROR_MESSAGE, ... }
+#     }
+#
+#    TRANSACTION_TIMESTAMP and TIME are in seconds since the Epoch (float).
+#    TRANSACTION_TIMESTAMP is taken by the sampler (its clock) and TIME is taken
+#    by this script (its clock).
+
+
+import json
+import time
+import argparse
+import threading
+
+from ovis_ldms import ldms
+
+if __name__ != "__main__":
+    raise ImportError("This is not a module")
+
+ldms.init(1024*1024*16)
+
+M = 1000000 # million: 1e6
+
+ap = argparse.ArgumentParser()
+ap.add_argument("-H", "--host", type=str, action="append", required=True,
+                help="ldmsd host[:port] (repeatable).")
+ap.add_argument("-P", "--port", type=int, default=10000,
+                help="The default ldmsd port.")
+ap.add_argument("-x", "--xprt", type=str, default="sock",
+                help="The LDMS transport.")
+ap.add_argument("-I", "--interval", type=int, default=M//20,
+                help="poll (update) interval (in micro seconds).")
+ap.add_argument("-D", "--duration", type=float, default=30,
+                help="The polling duration (in seconds).")
+args = ap.parse_args()
+
+records = dict() # host -> list of records
+errors = dict() # host -> error message
+t_end = time.time() + args.duration
+
+def poll(hostport):
+    host = hostport.partition(":")[0]
+    try:
+        _poll(hostport)
+    except Exception as e:
+        errors[host] = "{}: {}".format(type(e).__name__, e)
+
+def _poll(hostport):
+    host, _, port = hostport.partition(":")
+    port = int(port) if port else args.port
+    recs = records.setdefault(host, list())
+    x = ldms.Xprt(name=args.xprt)
+    x.connect(host=host, port=port)
+    sets = [ x.lookup(d.name) for d in x.dir() ]
+    seen = set()
+    for s in sets: # the samples already there before polling are not counted
+        s.update()
+        ts = s.transaction_timestamp
+        seen.add((s.name, ts["sec"], ts["usec"]))
+    I = args.interval
+    while True:
+        now = time.time()
+        if now >= t_end:
+            break
+        for s in sets:
+            s.update()
+            t = time.time()
+            ts = s.transaction_timestamp
+            key = (s.name, ts["sec"], ts["usec"])
+            if key in seen:
+                continue
+            seen.add(key)
+            recs.append({ "set": s.name, "ts": ts["sec"] + ts["usec"]/M,
+                          "seen": t })
+        t1 = (int(time.time()*M)//I + 1)*I/M # next poll
+        time.sleep(max(0, t1 - time.time()))
+    x.close()
+
+threads = [ threading.Thread(target=poll, args=(h,)) for h in args.host ]
+for t in threads:
+    t.start()
+for t in threads:
+    t.join()
+
+print(json.dumps({ "records": records, "errors": errors }))
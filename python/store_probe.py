@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+#
+# This script is originally meant to be run by `store_ingest_bench` inside the
+# storing aggregator container that `store_ingest_bench` generates.
+#
+# SYNOPSIS
+#     store_probe.py --csv DIR -D DURATION [-I POLL_INTERVAL]
+#     store_probe.py --sos CONTAINER -S SCHEMA -X INDEX -D DURATION \
+#                    [-I POLL_INTERVAL] [-W WINDOW]
+#
+# DESCRIPTION
+#     Polls the store every POLL_INTERVAL (seconds) for DURATION (seconds) and
+#     records the number of rows committed so far and the CPU time (user +
+#     system) consumed by `ldmsd` in the container. For each new row, the lag
+#     between the sample timestamp of the row and the time the row is first
+#     seen by this script is also recorded (except for the rows that are
+#     already in the store when the script starts).
+#
+#     --csv: all files under DIR (except the header files) are the CSV files
+#            of the store (store_csv). The first column is the timestamp.
+#     --sos: the rows are the objects of the SCHEMA in the SOS CONTAINER
+#            (store_sos, store_app), iterated backward from the end of INDEX
+#            (a timestamp-leading index) down to WINDOW seconds (default:
+#            3 poll intervals) before the newest timestamp seen so far. The
+#            rows of the other sets or nodes may commit later with an equal
+#            or earlier timestamp, so the rows in the window are counted per
+#            timestamp and only the count over the previous poll is new. The
+#            window is walked on every poll next to the ldmsd being measured,
+#            so keep it only as long as the rows may be late.
+#
+# OUTPUT FORMAT
+#     {
+#       "samples": [ [ TIME, ROWS, LDMSD_CPU_SEC ], ... ],
+#       "lags": [ LAG, ... ]
+#     }
+
+
+import os
+import json
+import time
+import argparse
+import subprocess
+
+if __name__ != "__main__":
+    raise ImportError("This is not a module")
+
+ap = argparse.ArgumentParser()
+ap.add_argument("--csv", type=str, help="store_csv directory.")
+ap.add_argument("--sos", type=str, help="SOS container path.")
+ap.add_argument("-S", "--schema", type=str, help="SOS schema name.")
+ap.add_argument("-X", "--index", type=str, default="time_job_comp",
+                help="SOS index name.")
+ap.add_argument("-D", "--duration", type=float, default=30,
+                help="The probing duration (in seconds).")
+ap.add_argument("-I", "--interval", type=float, default=1.0,
+                help="The poll interval (in seconds).")
+ap.add_argument("-W", "--window", type=float,
+                help="SOS: how far back (in seconds) from the newest "
+                     "timestamp the late rows are looked for "
+                     "(default: 3 poll intervals).")
+args = ap.parse_args()
+if args.window is None:
+    args.window = 3 * args.interval
+
+CLK_TCK = os.sysconf("SC_CLK_TCK")
+
+def ldmsd_cpu():
+    """CPU time (sec) of ldmsd in this container"""
+    try:
+        pid = subprocess.check_output(["pgrep", "-x", "ldmsd"]).split()[0]
+        with open(b"/proc/" + pid + b"/stat") as f:
+            st = f.read().rsplit(")", 1)[1].split()
+        return (int(st[11]) + int(st[12])) / CLK_TCK
+    except Exception:
+        return None
+
+class CSVProbe(object):
+    def __init__(self, path):
+        self.path = path
+        self.offsets = dict() # file -> offset
+        self.partial = dict() # file -> partial line
+        self.rows = 0
+
+    def poll(self, lags):
+        for root, dirs, files in os.walk(self.path):
+            for name in files:
+                if "HEADER" in name:
+                    continue
+                fpath = os.path.join(root, name)
+                off = self.offsets.get(fpath, 0)
+                with open(fpath, "rb") as f:
+                    f.seek(off)
+                    data = f.read()
+                self.offsets[fpath] = off + len(data)
+                lines = (self.partial.get(fpath, b"") + data).split(b"\n")
+                self.partial[fpath] = lines.pop() # incomplete last line
+                now = time.time()
+                for l in lines:
+                    if not l or l.startswith(b"#"):
+                        continue
+                    self.rows += 1
+                    try:
+                        lags.append(now - float(l.split(b",", 1)[0]))
+                    except ValueError:
+                        pass
+        return self.rows
+
+def ts_float(v):
+    if isinstance(v, (tuple, list)):
+        return float(v[0]) + 1e-6*float(v[1])
+    return float(v)
+
+class SOSProbe(object):
+    def __init__(self, path, schema, index, window):
+        self.path = path
+        self.schema = schema
+        self.index = index
+        self.window = window
+        self.last_ts = 0 # the newest timestamp seen
+        self.counts = dict() # timestamp -> rows seen (within the window)
+        self.rows = 0
+
+    def poll(self, lags):
+        from sosdb import Sos
+        cont = Sos.Container()
+        try:
+            cont.open(self.path)
+        except Exception:
+            return self.rows # not created yet
+        try:
+            schema = cont.schema_by_name(self.schema)
+            if not schema:
+                return self.rows
+            itr = schema[self.index].attr_iter()
+            now = time.time()
+            lo = self.last_ts - self.window
+            counts = dict()
+            b = itr.end()
+            while b:
+                ts = ts_float(itr.item()["timestamp"])
+                if ts <= lo:
+                    break
+                n = counts[ts] = counts.get(ts, 0) + 1
+                if n > self.counts.get(ts, 0): # a new row
+                    self.rows += 1
+                    lags.append(now - ts)
+                b = itr.prev()
+            self.last_ts = max([ self.last_ts ] + list(counts))
+            lo = self.last_ts - self.window
+            self.counts = { ts: n for ts, n in counts.items() if ts > lo }
+        finally:
+            cont.close()
+        return self.rows
+
+if args.csv:
+    probe = CSVProbe(args.csv)
+elif args.sos:
+    probe = SOSProbe(args.sos, args.schema, args.index, args.window)
+else:
+    ap.error("--csv or --sos is required")
+
+samples = []
+lags = []
+probe.poll([]) # the rows already there are not counted for the lag
+t_end = time.time() + args.duration
+while True:
+    now = time.time()
+    rows = probe.poll(lags)
+    samples.append([now, rows, ldmsd_cpu()])
+    if now >= t_end:
+        break
+    time.sleep(max(0, min(args.interval, t_end - time.time())))
+
+print(json.dumps({ "samples": samples, "lags": lags }))
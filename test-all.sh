@@ -1,35 +1,20 @@
 #!/bin/bash
 #
 # Usage: ./test-all.sh         # or
-#        OVIS_PREFIX=/my/ovis LOG=/my/log ./test-all.sh
+#        OVIS_PREFIX=/my/ovis LOG=/my/log JOBS=8 ./test-all.sh
 #
 # If OVIS_PREFIX environment variable is not specified, `/opt/ovis` is used.
 #
-# The output is printed to STDOUT and is also logged to a log file pointed to by
-# LOG environment varaible. The default LOG is ${HOME}/test-all.log.
+# The tests are run by `test-runner` with JOBS (default: 4) concurrent tests.
+# The output of each test is logged in its own file (see `test-runner --help`).
+# The runner output is printed to STDOUT and is also logged to a log file
+# pointed to by LOG environment varaible. The default LOG is
+# ${HOME}/test-all.log.
 
 # Use /opt/ovis by default
 OVIS_PREFIX=${OVIS_PREFIX:-/opt/ovis}
 LOG=${LOG:-${HOME}/test-all.log}
-
-LIST=(
-agg_slurm_test
-agg_test
-ldmsd_auth_ovis_test
-ldmsd_auth_test
-ldmsd_ctrl_test
-ldmsd_stream_test
-mt-slurm-test
-ovis_ev_test
-papi_sampler_test
-papi_store_test
-set_array_test
-setgroup_test
-slurm_stream_test
-spank_notifier_test
-store_app_test
-syspapi_test
-)
+JOBS=${JOBS:-4}
 
 [[ -d "${OVIS_PREFIX}" ]] || {
 	echo "ERROR: ${OVIS_PREFIX} is not found or is not a directory."
@@ -45,10 +30,5 @@ syspapi_test
 	exit -1
 }
 
-for T in ${LIST[*]}; do
-	echo "======== ${T} ========"
-	CMD="./${T} --prefix ${OVIS_PREFIX} $@"
-	echo ${CMD}
-	${CMD}
-	echo "----------------------------------------------"
-done 2>&1 | tee ${LOG}
+D=$(dirname $0)
+${D}/test-runner --prefix ${OVIS_PREFIX} --jobs ${JOBS} "$@" 2>&1 | tee ${LOG}
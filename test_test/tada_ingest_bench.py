@@ -0,0 +1,145 @@
+#!/usr/bin/python3
+#
+# Benchmark of storing finished tests into the TADA database: the per-object
+# get/commit path (what `tadad` used to do for every message) versus
+# `TADA_DB.saveTest()` (one transaction per test with `executemany` upserts).
+#
+# Example:
+#   ./tada_ingest_bench.py --tests 20 --assertions 285
+#   ./tada_ingest_bench.py --db-driver pgsql --db-host dbhost --db-user bob
+
+import os
+import time
+import json
+import argparse
+import tempfile
+
+from TADA import TADA_DB
+
+def make_test(test_id, num_assertions, num_metrics):
+    test = {
+        "test_id": test_id,
+        "test_suite": "LDMSD",
+        "test_type": "FVT",
+        "test_name": "ingest_bench",
+        "test_user": "bench",
+        "commit_id": "abcdefg",
+        "test_desc": "TADA ingest benchmark",
+        "test_start": int(time.time()),
+        "test_finish": int(time.time()),
+    }
+    assertions = [ {
+        "test_id": test_id,
+        "assert_id": i,
+        "assert_result": "passed",
+        "assert_cond": "cond {}".format(i),
+        "assert_desc": "assertion {}".format(i),
+    } for i in range(1, num_assertions + 1) ]
+    metrics = [ {
+        "test_id": test_id,
+        "metric_name": "metric{}".format(i),
+        "metric_tags": "",
+        "metric_value": 0.5 * i,
+        "metric_unit": "sec",
+    } for i in range(num_metrics) ]
+    return test, assertions, metrics
+
+def store_per_object(db, test, assertions, metrics):
+    """The old `tadad` path: get-or-create and commit every object"""
+    obj = db.getTest(test_id = test["test_id"])
+    for k, v in test.items():
+        setattr(obj, k, v)
+    obj.commit()
+    for a in assertions:
+        o = obj.getAssertion(a["assert_id"])
+        for k, v in a.items():
+            setattr(o, k, v)
+        o.commit()
+    for m in metrics:
+        o = obj.getMetric(m["metric_name"], m["metric_tags"])
+        for k, v in m.items():
+            setattr(o, k, v)
+        o.commit()
+
+def store_transaction(db, test, assertions, metrics):
+    db.saveTest(test, assertions, metrics)
+
+MODES = {
+    "per-object": store_per_object,
+    "transaction": store_transaction,
+}
+
+def count_statements(db):
+    """[ count ] updated by the sqlite trace callback (sqlite only)"""
+    counter = [ 0 ]
+    def _trace(stmt):
+        counter[0] += 1
+    if hasattr(db.conn, "set_trace_callback"):
+        db.conn.set_trace_callback(_trace)
+    else:
+        counter[0] = None
+    return counter
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description = "TADA ingest benchmark")
+    ap.add_argument("--db-driver", type = str, default = "sqlite")
+    ap.add_argument("--db-path", type = str,
+                    help = "sqlite database file (default: a temp file).")
+    ap.add_argument("--db-database", type = str, default = "tada_db")
+    ap.add_argument("--db-host", type = str, default = "localhost")
+    ap.add_argument("--db-port", type = int)
+    ap.add_argument("--db-user", type = str)
+    ap.add_argument("--db-password", type = str)
+    ap.add_argument("--tests", type = int, default = 20,
+                    help = "Number of tests stored in each mode.")
+    ap.add_argument("--assertions", type = int, default = 285,
+                    help = "Number of assertions per test "
+                           "(default: 285, like mt-slurm-test).")
+    ap.add_argument("--metrics", type = int, default = 0,
+                    help = "Number of metrics per test.")
+    args = ap.parse_args()
+
+    tmpdir = None
+    if args.db_driver == "sqlite" and not args.db_path:
+        tmpdir = tempfile.mkdtemp(prefix = "tada-ingest-")
+        args.db_path = tmpdir + "/tada_db.sqlite"
+    conf = { k: v for k, v in vars(args).items() \
+                  if k.startswith("db_") and v is not None }
+    db = TADA_DB(**conf)
+
+    results = dict()
+    for mode, fn in MODES.items():
+        tests = [ make_test("ingest-bench-{}-{}-{}".format(mode, os.getpid(), i),
+                            args.assertions, args.metrics) \
+                  for i in range(args.tests) ]
+        counter = count_statements(db)
+        t0 = time.time()
+        for test, assertions, metrics in tests:
+            fn(db, test, assertions, metrics)
+        dt = time.time() - t0
+        nstmt = counter[0]
+        if nstmt is not None:
+            db.conn.set_trace_callback(None)
+        # verify and clean up
+        for test, assertions, metrics in tests:
+            obj = db.getTest(test_id = test["test_id"])
+            assert(len(obj.assertions) == len(assertions))
+            assert(len(obj.metrics) == len(metrics))
+            obj.delete()
+        results[mode] = {
+            "sec_per_test": dt / args.tests,
+            "tests_per_sec": args.tests / dt if dt > 0 else None,
+            "statements_per_test": nstmt / args.tests \
+                                   if nstmt is not None else None,
+        }
+        print("{:12} {:10.6f} sec/test, {:10.1f} tests/sec, statements/test: {}" \
+              .format(mode, results[mode]["sec_per_test"],
+                      results[mode]["tests_per_sec"] or 0,
+                      results[mode]["statements_per_test"]))
+    speedup = results["per-object"]["sec_per_test"] / \
+              results["transaction"]["sec_per_test"]
+    print("speedup: {:.1f}x".format(speedup))
+    print(json.dumps(results))
+    if tmpdir:
+        os.unlink(args.db_path)
+        os.rmdir(tmpdir)